@@ -0,0 +1,111 @@
+from bs4 import BeautifulSoup
+from src.page_store import get_page_store
+from src.product_text import MARKUP_MODE
+from src.relevance_data import (
+    BM25_BACKEND,
+    get_relevance_data,
+    index_product_pages,
+    LUCENE_BACKEND,
+)
+from src.utilities import clean_html, clean_soup_in_passes
+from time import perf_counter
+
+
+class MismatchError(Exception):
+    pass
+
+
+# raw_pages_folder = "results/raw_product_pages"
+# compare cleaning in one walk to cleaning in passes on pages saved with --raw-capture
+# product_pages are already clean, so timing them would leave out most of the work
+def benchmark_cleaning(raw_pages_folder, number_of_pages=100):
+    page_store = get_page_store(raw_pages_folder)
+    ASINs = page_store.ASINs()[:number_of_pages]
+    if not ASINs:
+        print("No pages to benchmark")
+        return
+    passes_time = 0.0
+    timings = {}
+    for ASIN in ASINs:
+        page_source = page_store.read(ASIN)
+
+        start_time = perf_counter()
+        soup_in_passes = BeautifulSoup(
+            page_source.encode("utf-8"), "lxml", from_encoding="UTF-8"
+        )
+        clean_soup_in_passes(soup_in_passes)
+        passes_time = passes_time + perf_counter() - start_time
+
+        # sanity check
+        if str(clean_html(page_source, timings)) != str(soup_in_passes):
+            raise MismatchError(ASIN)
+
+    one_walk_time = timings["parse"] + timings["clean"]
+    print(
+        "in passes: {0:.3f}s, in one walk: {1:.3f}s (parse {2:.3f}s, clean {3:.3f}s), {4:.1f}x faster".format(
+            passes_time,
+            one_walk_time,
+            timings["parse"],
+            timings["clean"],
+            passes_time / one_walk_time,
+        )
+    )
+
+
+# how many of the top results to compare between backends
+TOP_RESULTS = 10
+
+
+# run lucene.initVM() first
+# compare the BM25 backend to the lucene backend on the same pages and queries
+def benchmark_relevance(
+    lucene_folder,
+    bm25_folder,
+    product_pages_folder,
+    queries,
+    number_of_matches=1000,
+    mode=MARKUP_MODE,
+):
+    times = {}
+    results = {}
+    for backend, index_folder in (
+        (LUCENE_BACKEND, lucene_folder),
+        (BM25_BACKEND, bm25_folder),
+    ):
+        start_time = perf_counter()
+        index_product_pages(index_folder, product_pages_folder, mode, backend=backend)
+        index_time = perf_counter() - start_time
+
+        start_time = perf_counter()
+        results[backend] = get_relevance_data(
+            index_folder, queries, number_of_matches, mode=mode, backend=backend
+        )
+        times[backend] = (index_time, perf_counter() - start_time)
+
+    # the scores differ a little, lucene rounds document lengths, so compare rankings
+    overlaps = []
+    for query in queries:
+        top_ASINs = [
+            set(
+                results[backend]
+                .loc[lambda data: data.loc[:, "query"] == query, "ASIN"]
+                .iloc[:TOP_RESULTS]
+            )
+            for backend in (LUCENE_BACKEND, BM25_BACKEND)
+        ]
+        union = top_ASINs[0].union(top_ASINs[1])
+        if union:
+            overlaps.append(len(top_ASINs[0].intersection(top_ASINs[1])) / len(union))
+
+    for backend, (index_time, query_time) in times.items():
+        print(
+            "{0}: index {1:.3f}s, {2:d} queries {3:.3f}s, {4:d} results".format(
+                backend, index_time, len(queries), query_time, results[backend].shape[0]
+            )
+        )
+    if overlaps:
+        print(
+            "top {0:d} overlap: {1:.1%}".format(
+                TOP_RESULTS, sum(overlaps) / len(overlaps)
+            )
+        )
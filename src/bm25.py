@@ -0,0 +1,264 @@
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import reduce
+from itertools import repeat
+from multiprocessing import get_context
+import numpy
+from os import cpu_count, path
+import re
+from src.page_store import get_page_store
+from src.product_text import (
+    extract_product_chunk,
+    FIELD_BOOSTS,
+    MARKUP_MODE,
+    PRODUCT_TEXT_FIELDS,
+)
+from src.relevance_data import SEARCH_THREADS
+from src.utilities import maybe_create
+
+# the BM25 relevance backend, see relevance_data
+# an inverted index in numpy arrays, memory-mapped from disk, so there's no JVM to start
+
+# the same as lucene's defaults
+K1 = 1.2
+B = 0.75
+
+# how many pages each process tokenizes at a time
+INDEX_CHUNK_SIZE = 100
+
+# one term per line, the line number is the term id
+TERMS_FILE = "terms.txt"
+# one ASIN per line, the line number is the document id
+ASINS_FILE = "ASINs.txt"
+
+# close to lucene's StandardAnalyzer, which splits on word boundaries and lowercases
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def get_fields(mode):
+    if mode == MARKUP_MODE:
+        return ["product_text"]
+    return PRODUCT_TEXT_FIELDS
+
+
+# each field has its own postings, so we can boost fields when we search
+def get_field_file(index_folder, field, kind):
+    return path.join(index_folder, field + "." + kind + ".npy")
+
+
+# ASINs = get_page_store(product_pages_folder).ASINs()[0:10]
+# returns ASIN, {field: term counts} for each page
+def tokenize_product_chunk(product_pages_folder, ASINs, mode):
+    return [
+        (
+            ASIN,
+            {field: Counter(tokenize(text)) for field, text in product_text.items()},
+        )
+        for ASIN, product_text in extract_product_chunk(
+            product_pages_folder, ASINs, mode
+        )
+    ]
+
+
+# rebuilds the whole index, it's fast enough that we don't need to update it
+def index_product_pages(
+    bm25_folder, product_pages_folder, mode=MARKUP_MODE, processes=cpu_count()
+):
+    maybe_create(bm25_folder)
+    ASINs = get_page_store(product_pages_folder).ASINs()
+    fields = get_fields(mode)
+    term_ids = {}
+    # field: term id: (document ids, term counts)
+    postings = {field: [] for field in fields}
+    # field: how many terms in each document
+    lengths = {field: array("f") for field in fields}
+
+    # benchmark_relevance runs this after starting lucene's JVM, which isn't safe to fork
+    with ProcessPoolExecutor(processes, mp_context=get_context("spawn")) as executor:
+        # document ids go up in order, so each posting list is already sorted
+        doc = 0
+        for tokenized_chunk in executor.map(
+            tokenize_product_chunk,
+            repeat(product_pages_folder),
+            [
+                ASINs[index : index + INDEX_CHUNK_SIZE]
+                for index in range(0, len(ASINs), INDEX_CHUNK_SIZE)
+            ],
+            repeat(mode),
+        ):
+            for ASIN, term_counts_by_field in tokenized_chunk:
+                for field in fields:
+                    term_counts = term_counts_by_field[field]
+                    field_postings = postings[field]
+                    for term, count in term_counts.items():
+                        term_id = term_ids.get(term)
+                        if term_id is None:
+                            term_id = len(term_ids)
+                            term_ids[term] = term_id
+                        while len(field_postings) <= term_id:
+                            field_postings.append((array("i"), array("f")))
+                        (docs, counts) = field_postings[term_id]
+                        docs.append(doc)
+                        counts.append(count)
+                    lengths[field].append(sum(term_counts.values()))
+                doc = doc + 1
+
+    number_of_terms = len(term_ids)
+    for field in fields:
+        field_postings = postings[field]
+        offsets = numpy.zeros(number_of_terms + 1, dtype=numpy.int64)
+        all_docs = array("i")
+        all_counts = array("f")
+        for term_id in range(number_of_terms):
+            if term_id < len(field_postings):
+                (docs, counts) = field_postings[term_id]
+                all_docs.extend(docs)
+                all_counts.extend(counts)
+            offsets[term_id + 1] = len(all_docs)
+        numpy.save(get_field_file(bm25_folder, field, "offsets"), offsets)
+        numpy.save(
+            get_field_file(bm25_folder, field, "docs"),
+            numpy.frombuffer(all_docs, dtype=numpy.int32),
+        )
+        numpy.save(
+            get_field_file(bm25_folder, field, "counts"),
+            numpy.frombuffer(all_counts, dtype=numpy.float32),
+        )
+        numpy.save(
+            get_field_file(bm25_folder, field, "lengths"),
+            numpy.frombuffer(lengths[field], dtype=numpy.float32),
+        )
+
+    with open(path.join(bm25_folder, TERMS_FILE), "w", encoding="UTF-8") as io:
+        for term in term_ids.keys():
+            io.write(term + "\n")
+    with open(path.join(bm25_folder, ASINS_FILE), "w", encoding="UTF-8") as io:
+        for ASIN in ASINs:
+            io.write(ASIN + "\n")
+    print("Indexed {0:d} pages, {1:d} terms".format(len(ASINs), number_of_terms))
+
+
+def read_lines(file):
+    with open(file, "r", encoding="UTF-8") as io:
+        return io.read().splitlines()
+
+
+class BM25Index:
+    def __init__(self, bm25_folder, mode, field_boosts):
+        self.fields = get_fields(mode)
+        self.term_ids = {
+            term: term_id
+            for term_id, term in enumerate(read_lines(path.join(bm25_folder, TERMS_FILE)))
+        }
+        self.ASINs = read_lines(path.join(bm25_folder, ASINS_FILE))
+        # only the parts we search get read in from disk
+        self.postings = {
+            field: tuple(
+                numpy.load(get_field_file(bm25_folder, field, kind), mmap_mode="r")
+                for kind in ("offsets", "docs", "counts")
+            )
+            for field in self.fields
+        }
+        if mode == MARKUP_MODE:
+            self.boosts = {"product_text": 1.0}
+        else:
+            self.boosts = {field: field_boosts.get(field, 1.0) for field in self.fields}
+        # BM25F, so a word in a boosted field counts for more, and makes the document longer
+        lengths = sum(
+            self.boosts[field]
+            * numpy.load(get_field_file(bm25_folder, field, "lengths"))
+            for field in self.fields
+        )
+        self.length_norms = K1 * (1 - B + B * lengths / max(lengths.mean(), 1e-9))
+        self.number_of_documents = len(self.ASINs)
+
+    # sorted document ids and boosted counts for a term
+    def get_postings(self, term_id):
+        field_docs = []
+        field_counts = []
+        for field in self.fields:
+            (offsets, docs, counts) = self.postings[field]
+            start = offsets[term_id]
+            end = offsets[term_id + 1]
+            field_docs.append(docs[start:end])
+            field_counts.append(self.boosts[field] * counts[start:end])
+        (term_docs, indices) = numpy.unique(
+            numpy.concatenate(field_docs), return_inverse=True
+        )
+        return term_docs, numpy.bincount(
+            indices, weights=numpy.concatenate(field_counts), minlength=len(term_docs)
+        )
+
+    # all the query words have to match, like lucene with the AND operator
+    # returns the ASINs and scores, best first
+    def search(self, query, number_of_matches, minimum_score=None):
+        term_postings = []
+        for term in tokenize(query):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                return [], numpy.zeros(0)
+            term_postings.append(self.get_postings(term_id))
+        if not term_postings:
+            return [], numpy.zeros(0)
+
+        matches = reduce(
+            lambda docs, postings: numpy.intersect1d(
+                docs, postings[0], assume_unique=True
+            ),
+            term_postings[1:],
+            term_postings[0][0],
+        )
+        length_norms = self.length_norms[matches]
+        scores = numpy.zeros(len(matches))
+        for term_docs, counts in term_postings:
+            number_with_term = len(term_docs)
+            inverse_document_frequency = numpy.log(
+                1
+                + (self.number_of_documents - number_with_term + 0.5)
+                / (number_with_term + 0.5)
+            )
+            match_counts = counts[numpy.searchsorted(term_docs, matches)]
+            scores = scores + inverse_document_frequency * match_counts / (
+                match_counts + length_norms
+            )
+
+        if not minimum_score is None:
+            above_minimum = scores >= minimum_score
+            matches = matches[above_minimum]
+            scores = scores[above_minimum]
+        if len(scores) > number_of_matches:
+            # only fully sort the top ones
+            top = numpy.argpartition(-scores, number_of_matches - 1)[:number_of_matches]
+        else:
+            top = numpy.arange(len(scores))
+        top = top[numpy.argsort(-scores[top], kind="stable")]
+        return [self.ASINs[doc] for doc in matches[top]], scores[top]
+
+
+# yields query, ASINs, scores for each query, in order
+# numpy lets go of the GIL for the heavy lifting, so threads still help
+def search_queries(
+    bm25_folder,
+    queries,
+    number_of_matches,
+    minimum_score=None,
+    threads=SEARCH_THREADS,
+    mode=MARKUP_MODE,
+    field_boosts=FIELD_BOOSTS,
+):
+    bm25_index = BM25Index(bm25_folder, mode, field_boosts)
+    with ThreadPoolExecutor(threads) as executor:
+        for query, (ASINs, scores) in zip(
+            queries,
+            executor.map(
+                lambda query: bm25_index.search(query, number_of_matches, minimum_score),
+                queries,
+            ),
+        ):
+            print(query)
+            yield query, ASINs, scores
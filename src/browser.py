@@ -0,0 +1,382 @@
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from selenium import webdriver
+from selenium.common.exceptions import (
+    JavascriptException,
+    TimeoutException,
+    WebDriverException,
+)
+from selenium.webdriver.common.by import By
+from selenium.webdriver.firefox.options import Options
+from selenium.webdriver.support.expected_conditions import staleness_of
+from selenium.webdriver.support.wait import WebDriverWait as wait
+from src.utilities import (
+    clean_html,
+    FOILED_AGAIN_SELECTOR,
+    FoiledAgainError,
+    GONE_SELECTOR,
+    GoneError,
+    NAV_FOOTER_SELECTOR,
+    only,
+    WAIT_TIME,
+    WENT_WRONG_SELECTOR,
+    WentWrongError,
+)
+from threading import Lock
+from time import perf_counter
+
+# everything that needs selenium, so stages without a browser don't import it
+
+HEADLESS = False
+
+FAKESPOT_FILE = "/home/brandon/snap/firefox/common/.mozilla/firefox/fi1pyptz.default/extensions/{44df5123-f715-9146-bfaa-c6e8d4461d44}.xpi"
+
+
+def new_browser(user_agent, fakespot=False):
+    options = Options()
+    # add headless to avoid the visual display and speed things up
+    if HEADLESS:
+        options.add_argument("-headless")
+    options.set_preference("general.useragent.override", user_agent)
+    # this helps pages load faster I guess?
+    options.set_capability("pageLoadStrategy", "eager")
+
+    browser = webdriver.Firefox(options=options)
+    # selenium sputters when scripts run too long so set a timeout
+    browser.set_script_timeout(WAIT_TIME)
+    # throw an error if we wait too long
+    browser.set_page_load_timeout(WAIT_TIME)
+    if fakespot:
+        browser.execute("INSTALL_ADDON", {"path": FAKESPOT_FILE, "temporary": True})
+        # wait for fakespot to open a new tab
+        wait(browser, WAIT_TIME).until(lambda browser: len(browser.window_handles) > 1)
+        # close it
+        browser.switch_to.window(browser.window_handles[1])
+        browser.close()
+        # return to main tab
+        browser.switch_to.window(browser.window_handles[0])
+
+    return browser
+
+
+# how often to check whether the old page is gone
+UNLOAD_POLL_TIME = 0.05
+
+# recycle browsers after this many pages, because firefox memory grows over time
+PAGES_PER_BROWSER = 200
+
+# how many browsers to keep warmed up and ready to go
+SPARE_BROWSERS = 1
+
+
+def is_healthy(browser):
+    try:
+        # these fail if firefox has crashed or the session is gone
+        browser.window_handles
+        browser.current_url
+        return True
+    except WebDriverException:
+        return False
+
+
+def quit_browser(browser):
+    try:
+        browser.quit()
+    except WebDriverException:
+        # already dead
+        pass
+
+
+# start browsers with different user agents in the background
+# so switching to a new user agent after a captcha is nearly instant
+class BrowserPool:
+    def __init__(
+        self,
+        user_agents,
+        user_agent_index=0,
+        fakespot=False,
+        spare_browsers=SPARE_BROWSERS,
+        pages_per_browser=PAGES_PER_BROWSER,
+    ):
+        self.user_agents = user_agents
+        # the index of the user agent of the last browser we handed out
+        # pass this back in as user_agent_index next time
+        self.user_agent_index = user_agent_index
+        # the index of the last user agent we started a browser with
+        self.warm_user_agent_index = user_agent_index - 1
+        self.fakespot = fakespot
+        self.pages_per_browser = pages_per_browser
+        self.lock = Lock()
+        self.page_counts = {}
+        self.ready_browsers = Queue()
+        self.executor = ThreadPoolExecutor(spare_browsers)
+        for _ in range(spare_browsers):
+            self.warm_up()
+
+    def warm_up(self):
+        with self.lock:
+            # start again if we're at the end
+            self.warm_user_agent_index = (self.warm_user_agent_index + 1) % len(
+                self.user_agents
+            )
+            user_agent_index = self.warm_user_agent_index
+
+        self.executor.submit(self.start_browser, user_agent_index)
+
+    def start_browser(self, user_agent_index):
+        try:
+            self.ready_browsers.put(
+                (
+                    new_browser(
+                        self.user_agents[user_agent_index], fakespot=self.fakespot
+                    ),
+                    user_agent_index,
+                )
+            )
+        except Exception as exception:
+            # put the error in the queue, so get can raise it
+            self.ready_browsers.put(exception)
+
+    # get a warmed up browser, and start warming up a replacement
+    def get(self):
+        while True:
+            ready_browser = self.ready_browsers.get()
+            self.warm_up()
+            if isinstance(ready_browser, Exception):
+                raise ready_browser
+            (browser, user_agent_index) = ready_browser
+            if is_healthy(browser):
+                with self.lock:
+                    self.page_counts[browser] = 0
+                    self.user_agent_index = user_agent_index
+                return browser
+            quit_browser(browser)
+
+    def release(self, browser):
+        with self.lock:
+            self.page_counts.pop(browser, None)
+        quit_browser(browser)
+
+    # if Amazon sends a captcha, change the user agent and try again
+    def switch(self, browser):
+        self.release(browser)
+        return self.get()
+
+    # call after every page
+    # returns a fresh browser if this one is too old or has crashed
+    def recycle(self, browser):
+        with self.lock:
+            page_count = self.page_counts.get(browser, 0) + 1
+            self.page_counts[browser] = page_count
+        if page_count >= self.pages_per_browser or not is_healthy(browser):
+            return self.switch(browser)
+        return browser
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        while not self.ready_browsers.empty():
+            ready_browser = self.ready_browsers.get()
+            if not isinstance(ready_browser, Exception):
+                quit_browser(ready_browser[0])
+
+
+def get_clean_soup(browser):
+    return clean_html(browser.page_source)
+
+
+# what a page can turn out to be, from the rules below
+READY = "ready"
+FOILED_AGAIN = "foiled_again"
+GONE = "gone"
+WENT_WRONG = "went_wrong"
+# nothing matched in time
+TIMED_OUT = "timeout"
+
+# the old page is gone, so the new one has started
+UNLOAD_STAGE = "unload"
+AMAZON_STAGE = "amazon"
+FAKESPOT_OPT_IN_STAGE = "fakespot_opt_in"
+FAKESPOT_STAGE = "fakespot"
+
+# readiness rules for each kind of page, checked in order
+# (result, css selector, text the element itself has to contain or None, only after the load event)
+# only the element's own text counts, not the text of everything inside it
+# error pages might show their picture before the footer loads, so only trust them once the page has loaded
+AMAZON_RULES = [
+    (READY, NAV_FOOTER_SELECTOR, None, False),
+    (FOILED_AGAIN, FOILED_AGAIN_SELECTOR, None, True),
+    (GONE, GONE_SELECTOR, None, True),
+    (WENT_WRONG, WENT_WRONG_SELECTOR, None, True),
+]
+
+FAKESPOT_OPT_IN_RULES = [(READY, "button#fs-opt-in", None, False)]
+
+# products without a grade wait until we time out
+# we could stop as soon as fakespot says there's no grade, but only once we've seen what that looks like in a real capture
+FAKESPOT_RULES = [(READY, "div.fakespot-main-grade-box-wrapper", None, False)]
+
+# check the rules whenever the page changes or finishes loading, instead of polling
+# calls back with the first result that matches, or null if nothing matches in time
+WAIT_SCRIPT = """
+var rules = arguments[0];
+var timeout = arguments[1];
+var callback = arguments[arguments.length - 1];
+var finished = false;
+var observer = null;
+
+function finish(result) {
+    if (finished) {
+        return;
+    }
+    finished = true;
+    observer.disconnect();
+    window.removeEventListener("load", check);
+    callback(result);
+}
+
+// just the text directly inside the element, not inside its children
+function ownText(element) {
+    var text = "";
+    for (var index = 0; index < element.childNodes.length; index++) {
+        if (element.childNodes[index].nodeType == Node.TEXT_NODE) {
+            text = text + element.childNodes[index].nodeValue;
+        }
+    }
+    return text;
+}
+
+function matches(rule) {
+    if (rule[3] && document.readyState != "complete") {
+        return false;
+    }
+    var elements = document.querySelectorAll(rule[1]);
+    for (var index = 0; index < elements.length; index++) {
+        if (rule[2] === null || ownText(elements[index]).toLowerCase().indexOf(rule[2]) >= 0) {
+            return true;
+        }
+    }
+    return false;
+}
+
+function check() {
+    for (var index = 0; index < rules.length; index++) {
+        if (matches(rules[index])) {
+            finish(rules[index][0]);
+            return;
+        }
+    }
+}
+
+observer = new MutationObserver(check);
+observer.observe(document, {childList: true, subtree: true, characterData: true});
+window.addEventListener("load", check);
+setTimeout(function () { finish(null); }, timeout);
+check();
+"""
+
+
+# how long we spend waiting at each stage, across all browsers, so we can tune the waits
+class WaitTimes:
+    def __init__(self):
+        self.lock = Lock()
+        # stage: list of seconds
+        self.seconds = {}
+        # stage: {result: count}
+        self.results = {}
+
+    def add(self, stage, result, seconds):
+        with self.lock:
+            self.seconds.setdefault(stage, []).append(seconds)
+            stage_results = self.results.setdefault(stage, {})
+            stage_results[result] = stage_results.get(result, 0) + 1
+
+    def report(self):
+        with self.lock:
+            for stage in sorted(self.seconds):
+                stage_seconds = sorted(self.seconds[stage])
+                number_of_waits = len(stage_seconds)
+                print(
+                    "{0}: {1:d} waits, {2:.2f}s median, {3:.2f}s 90th percentile, {4:.2f}s max, {5}".format(
+                        stage,
+                        number_of_waits,
+                        stage_seconds[number_of_waits // 2],
+                        stage_seconds[number_of_waits * 9 // 10],
+                        stage_seconds[-1],
+                        ", ".join(
+                            "{0} {1:d}".format(result, count)
+                            for result, count in sorted(self.results[stage].items())
+                        ),
+                    )
+                )
+
+
+wait_times = WaitTimes()
+
+
+# returns the result of the first rule that matches, or TIMED_OUT
+def wait_for_rules(browser, stage, rules, wait_time=WAIT_TIME):
+    start_time = perf_counter()
+    result = None
+    while result is None:
+        time_left = wait_time - (perf_counter() - start_time)
+        if time_left <= 0:
+            result = TIMED_OUT
+            break
+        try:
+            result = browser.execute_async_script(
+                WAIT_SCRIPT, rules, int(time_left * 1000)
+            )
+            if result is None:
+                result = TIMED_OUT
+        except JavascriptException:
+            # the page navigated while we were watching it, so watch the new one
+            continue
+        except TimeoutException:
+            result = TIMED_OUT
+    wait_times.add(stage, result, perf_counter() - start_time)
+    return result
+
+
+# start loading a url, without waiting for it to load
+# returns the page we're leaving, so wait_for_amazon can tell when it's gone
+def start_loading(browser, url):
+    old_page = get_page(browser)
+    browser.execute_script("window.location.href = arguments[0];", url)
+    return old_page
+
+
+# the current page, to pass to wait_for_amazon after we leave it
+def get_page(browser):
+    return only(browser.find_elements(By.TAG_NAME, "html"))
+
+
+# the result of the first error rule that matches now, loaded or not, or TIMED_OUT
+def find_error_page(browser):
+    for result, selector, _, _ in AMAZON_RULES:
+        if result != READY and browser.find_elements(By.CSS_SELECTOR, selector):
+            return result
+    return TIMED_OUT
+
+
+# pass the page we left if we started loading a new one without waiting for it
+# after browser.get, the new page has already started
+def wait_for_amazon(browser, old_page=None):
+    if not old_page is None:
+        start_time = perf_counter()
+        wait(browser, WAIT_TIME, poll_frequency=UNLOAD_POLL_TIME).until(
+            staleness_of(old_page)
+        )
+        wait_times.add(UNLOAD_STAGE, READY, perf_counter() - start_time)
+
+    result = wait_for_rules(browser, AMAZON_STAGE, AMAZON_RULES)
+    if result == TIMED_OUT:
+        # a blocked page might never finish loading, so look for the error pages anyway
+        result = find_error_page(browser)
+    if result == FOILED_AGAIN:
+        raise FoiledAgainError()
+    if result == GONE:
+        raise GoneError()
+    if result == WENT_WRONG:
+        raise WentWrongError()
+    if result == TIMED_OUT:
+        raise TimeoutException("Amazon didn't load")
@@ -0,0 +1,130 @@
+from bs4 import Tag
+from collections import namedtuple
+import re
+import soupsieve
+from src.lxml_backend import LxmlNode
+from src.utilities import only
+
+# how many widgets a field expects
+# every widget
+ALL = "all"
+# the first widget, if there are any
+FIRST = "first"
+# exactly one widget, if there are any
+ONLY = "only"
+
+# name: the key to look up the field by
+# selector: a CSS selector for the widgets
+# cardinality: one of ALL, FIRST, or ONLY
+# transform: a function to apply to the widget (or list of widgets, for ALL)
+# default: the value if there are no widgets
+FieldSpec = namedtuple(
+    "FieldSpec",
+    ["name", "selector", "cardinality", "transform", "default"],
+    defaults=[ALL, None, None],
+)
+
+
+# for fields where we only care that the widget is there
+def always_true(widget):
+    return True
+
+
+def get_text(widget):
+    return widget.text
+
+
+# the tag name a selector has to end on, or None if it could end on any tag
+# e.g. "div#dp a.link" has to end on an "a" tag
+def get_last_tag_name(selector):
+    # commas mean there is more than one selector, so we can't be sure
+    if "," in selector:
+        return None
+    # attributes and pseudo-class arguments can contain spaces, so blank them out
+    without_brackets = re.sub(r"\([^)]*\)", "()", re.sub(r"\[[^\]]*\]", "[]", selector))
+    last_compound = re.split(r"[\s>+~]+", without_brackets.strip())[-1]
+    tag_name_match = re.match(r"[A-Za-z][\w-]*", last_compound)
+    if tag_name_match is None:
+        return None
+    return tag_name_match.group(0).lower()
+
+
+def resolve_field(field_spec, widgets):
+    if field_spec.cardinality == ALL:
+        if field_spec.transform is None:
+            return widgets
+        return field_spec.transform(widgets)
+
+    if not widgets:
+        return field_spec.default
+
+    if field_spec.cardinality == FIRST:
+        widget = widgets[0]
+    else:
+        widget = only(widgets)
+
+    if field_spec.transform is None:
+        return widget
+    return field_spec.transform(widget)
+
+
+# fields are only resolved when we ask for them
+# so cardinality errors happen in the same order as separate selects would
+class ExtractedFields:
+    def __init__(self, field_specs, matches):
+        self.field_specs = field_specs
+        self.matches = matches
+        self.values = {}
+
+    def __getitem__(self, name):
+        if not name in self.values:
+            self.values[name] = resolve_field(
+                self.field_specs[name], self.matches[name]
+            )
+        return self.values[name]
+
+
+# compile the selectors for a set of fields once
+# then find the widgets for every field in one walk through the tree
+class FieldExtractor:
+    def __init__(self, field_specs):
+        self.field_specs = {
+            field_spec.name: field_spec for field_spec in field_specs
+        }
+        # only try selectors on tags they could possibly match
+        self.matchers_by_tag_name = {}
+        self.any_tag_matchers = []
+        for field_spec in field_specs:
+            matcher = (field_spec.name, soupsieve.compile(field_spec.selector))
+            tag_name = get_last_tag_name(field_spec.selector)
+            if tag_name is None:
+                self.any_tag_matchers.append(matcher)
+            else:
+                self.matchers_by_tag_name.setdefault(tag_name, []).append(matcher)
+
+    # like root.select, the root itself is not included
+    def extract(self, root):
+        # compiled XPath runs in C, so a query per field is already fast
+        if isinstance(root, LxmlNode):
+            return ExtractedFields(
+                self.field_specs,
+                {
+                    name: root.select(field_spec.selector)
+                    for name, field_spec in self.field_specs.items()
+                },
+            )
+
+        matches = {name: [] for name in self.field_specs}
+        matchers_by_tag_name = self.matchers_by_tag_name
+        any_tag_matchers = self.any_tag_matchers
+        for tag in root.descendants:
+            if not isinstance(tag, Tag):
+                continue
+            for name, matcher in matchers_by_tag_name.get(tag.name, ()):
+                if matcher.match(tag):
+                    matches[name].append(tag)
+            for name, matcher in any_tag_matchers:
+                if matcher.match(tag):
+                    matches[name].append(tag)
+
+        return ExtractedFields(self.field_specs, matches)
@@ -0,0 +1,285 @@
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+import asyncio
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from lxml import html
+import re
+from src.lxml_backend import compile_selector
+from src.page_store import (
+    get_page_store,
+    HTTP_SOURCE,
+    PageSources,
+    save_page_source,
+)
+from src.product_saver import BACKOFF_TIME, MAX_TRIES, Progress
+from src.utilities import (
+    FOILED_AGAIN_SELECTOR,
+    FoiledAgainError,
+    GONE_SELECTOR,
+    GoneError,
+    NAV_FOOTER_SELECTOR,
+    only,
+    WAIT_TIME,
+    WENT_WRONG_SELECTOR,
+    WentWrongError,
+)
+from time import time
+
+AMAZON_URL = "https://www.amazon.com/"
+
+# how many requests to have open at once
+CONCURRENT_REQUESTS = 8
+
+
+# error if the page came back without a footer, but no error either
+class IncompletePageError(Exception):
+    pass
+
+
+# the same checks as wait_for_amazon, but on the html we got back
+def check_amazon_html(page_source):
+    if page_source.strip() == "":
+        raise IncompletePageError()
+
+    tree = html.fromstring(page_source)
+    if compile_selector(NAV_FOOTER_SELECTOR)(tree):
+        return
+
+    for selector, error in (
+        (FOILED_AGAIN_SELECTOR, FoiledAgainError),
+        (GONE_SELECTOR, GoneError),
+        (WENT_WRONG_SELECTOR, WentWrongError),
+    ):
+        matches = compile_selector(selector)(tree)
+        if matches:
+            # sanity check
+            only(matches)
+            raise error()
+
+    raise IncompletePageError()
+
+
+# html is already rendered on the server for most of our fields
+# so we don't need a browser, except for the fakespot grade
+async def fetch_product_page(
+    session, user_agent, ASIN, product_pages_folder, page_sources, base_url
+):
+    async with session.get(
+        base_url + "dp/" + ASIN, headers={"User-Agent": user_agent}
+    ) as response:
+        page_source = await response.text()
+
+    check_amazon_html(page_source)
+    # cleaning is CPU work, so get it off the event loop
+    await asyncio.get_running_loop().run_in_executor(
+        None,
+        save_page_source,
+        product_pages_folder,
+        ASIN,
+        page_source,
+    )
+    # so a browser can come back for the fakespot grade
+    page_sources.add(ASIN, HTTP_SOURCE)
+
+
+# share the user agent across all the workers
+class UserAgentRotation:
+    def __init__(self, user_agents, user_agent_index):
+        self.user_agents = user_agents
+        self.user_agent_index = user_agent_index
+
+    def current(self):
+        return self.user_agents[self.user_agent_index]
+
+    # if Amazon sends a captcha, change the user agent
+    def switch(self, session):
+        self.user_agent_index = (self.user_agent_index + 1) % len(self.user_agents)
+        # amazon remembers us with cookies, so forget them too
+        session.cookie_jar.clear()
+
+
+# put a retry back on the queue once it's ready
+# until then it counts as unfinished, so the workers don't stop early
+def requeue(ASIN_queue, item):
+    ASIN_queue.put_nowait(item)
+    ASIN_queue.task_done()
+
+
+async def fetch_product_pages(
+    worker_id,
+    session,
+    ASIN_queue,
+    progress,
+    rotation,
+    browser_ASINs,
+    product_pages_folder,
+    page_sources,
+    base_url,
+):
+    while True:
+        (retry_time, tries, ASIN) = await ASIN_queue.get()
+        # whether a retry will mark this item done later
+        retrying = False
+        try:
+            tries = tries + 1
+            user_agent = rotation.current()
+            try:
+                await fetch_product_page(
+                    session,
+                    user_agent,
+                    ASIN,
+                    product_pages_folder,
+                    page_sources,
+                    base_url,
+                )
+                progress.add("saved")
+            except GoneError:
+                print(str(ASIN))
+                print("Page no longer exists, skipping")
+                progress.add("gone")
+            except FoiledAgainError:
+                # another worker might have already switched
+                if rotation.current() == user_agent:
+                    rotation.switch(session)
+                if tries >= MAX_TRIES:
+                    # give it to a browser instead
+                    print(str(ASIN))
+                    print("Captcha, leaving for a browser")
+                    browser_ASINs.append(ASIN)
+                    progress.add("failed")
+                else:
+                    ASIN_queue.put_nowait((time(), tries, ASIN))
+            except (
+                asyncio.TimeoutError,
+                ClientError,
+                IncompletePageError,
+                WentWrongError,
+            ) as an_error:
+                if tries >= MAX_TRIES:
+                    print(str(ASIN))
+                    print(type(an_error).__name__ + ", giving up")
+                    progress.add("failed")
+                else:
+                    # don't hold up this worker while we wait
+                    backoff_time = BACKOFF_TIME * 2 ** (tries - 1)
+                    asyncio.get_running_loop().call_later(
+                        backoff_time,
+                        requeue,
+                        ASIN_queue,
+                        (time() + backoff_time, tries, ASIN),
+                    )
+                    retrying = True
+        finally:
+            if not retrying:
+                ASIN_queue.task_done()
+
+
+async def fetch_all_product_pages(
+    user_agents,
+    ASINs,
+    product_pages_folder,
+    page_sources_file,
+    user_agent_index,
+    concurrent_requests,
+    base_url,
+):
+    # don't save a product we already have
+    completed_product_filenames = set(get_page_store(product_pages_folder).ASINs())
+    ASIN_queue = asyncio.PriorityQueue()
+    start_time = time()
+    for ASIN in ASINs:
+        if not ASIN in completed_product_filenames:
+            ASIN_queue.put_nowait((start_time, 0, ASIN))
+
+    progress = Progress(ASIN_queue.qsize())
+    rotation = UserAgentRotation(user_agents, user_agent_index)
+    browser_ASINs = []
+    # one keep-alive connection pool for all the requests
+    page_sources = PageSources(page_sources_file)
+    async with ClientSession(
+        connector=TCPConnector(limit=concurrent_requests),
+        timeout=ClientTimeout(total=WAIT_TIME),
+    ) as session:
+        workers = [
+            asyncio.create_task(
+                fetch_product_pages(
+                    worker_id,
+                    session,
+                    ASIN_queue,
+                    progress,
+                    rotation,
+                    browser_ASINs,
+                    product_pages_folder,
+                    page_sources,
+                    base_url,
+                )
+            )
+            for worker_id in range(concurrent_requests)
+        ]
+        # done once every product, and every retry, is finished
+        finished = asyncio.create_task(ASIN_queue.join())
+        # or stop early if a worker dies
+        await asyncio.wait([finished] + workers, return_when=asyncio.FIRST_COMPLETED)
+        for worker in workers:
+            if worker.done():
+                # raise any errors from the workers
+                worker.result()
+            else:
+                worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    page_sources.close()
+    progress.report()
+    return browser_ASINs
+
+
+# returns the ASINs we couldn't get past a captcha for
+# the pages we did get are logged in page_sources_file, because they have no fakespot grade
+# pass the same file to multithread_save_product_pages with grade_http_pages, to visit them again for the grade
+def http_save_product_pages(
+    user_agents,
+    ASINs,
+    product_pages_folder,
+    page_sources_file,
+    user_agent_index=0,
+    concurrent_requests=CONCURRENT_REQUESTS,
+    base_url=AMAZON_URL,
+):
+    return asyncio.run(
+        fetch_all_product_pages(
+            user_agents,
+            ASINs,
+            product_pages_folder,
+            page_sources_file,
+            user_agent_index,
+            concurrent_requests,
+            base_url,
+        )
+    )
+
+
+DP_PATTERN = r"/dp/([^/?]*)"
+
+
+# serve recorded pages, to test without hitting amazon
+# cleaning strips the footer, so check_amazon_html rejects cleaned pages
+# record with --raw-capture, and serve the raw_product_pages folder
+# http_save_product_pages(user_agents, ASINs, folder, sources_file, base_url="http://localhost:8000/")
+def run_stub_server(raw_pages_folder, port=8000):
+    page_store = get_page_store(raw_pages_folder)
+    recorded_ASINs = set(page_store.ASINs())
+
+    class RecordedPageHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            ASIN_match = re.match(DP_PATTERN, self.path)
+            if ASIN_match is None or not ASIN_match.group(1) in recorded_ASINs:
+                self.send_response(404)
+                self.end_headers()
+                return
+            page_source = page_store.read(ASIN_match.group(1)).encode("UTF-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=UTF-8")
+            self.send_header("Content-Length", str(len(page_source)))
+            self.end_headers()
+            self.wfile.write(page_source)
+
+    ThreadingHTTPServer(("localhost", port), RecordedPageHandler).serve_forever()
@@ -0,0 +1,94 @@
+from cssselect import HTMLTranslator
+from lxml import etree, html
+
+# compile each CSS selector to XPath only once
+COMPILED_SELECTORS = {}
+
+
+def compile_selector(selector):
+    compiled_selector = COMPILED_SELECTORS.get(selector)
+    if compiled_selector is None:
+        compiled_selector = etree.XPath(HTMLTranslator().css_to_xpath(selector))
+        COMPILED_SELECTORS[selector] = compiled_selector
+    return compiled_selector
+
+
+# a bit of text between tags, with .text like a BeautifulSoup string
+class LxmlText(str):
+    @property
+    def text(self):
+        return self
+
+
+# skip comments and processing instructions
+def is_element(element):
+    return isinstance(element.tag, str)
+
+
+# wrap an lxml element so it works like the BeautifulSoup tags the parser expects
+# parse_html strips all the text in the page up front
+# here we only strip the text we actually read
+class LxmlNode:
+    def __init__(self, element):
+        self.element = element
+
+    @property
+    def name(self):
+        return self.element.tag
+
+    @property
+    def parent(self):
+        parent = self.element.getparent()
+        if parent is None:
+            return None
+        return LxmlNode(parent)
+
+    # like BeautifulSoup after remove_whitespace
+    # stripped text, without the text that was only whitespace
+    @property
+    def contents(self):
+        element = self.element
+        contents = []
+        if element.text:
+            stripped = element.text.strip()
+            if stripped != "":
+                contents.append(LxmlText(stripped))
+        for child in element:
+            if is_element(child):
+                contents.append(LxmlNode(child))
+            if child.tail:
+                stripped = child.tail.strip()
+                if stripped != "":
+                    contents.append(LxmlText(stripped))
+        return contents
+
+    @property
+    def text(self):
+        return "".join(text.strip() for text in self.element.itertext())
+
+    def __getitem__(self, attribute):
+        value = self.element.attrib[attribute]
+        # BeautifulSoup splits classes into a list
+        if attribute == "class":
+            return value.split()
+        return value
+
+    # like BeautifulSoup, only return descendants
+    # only search below this element, instead of the whole page
+    # so the whole selector has to match inside it, which all of the parser's selectors do
+    # cross_check_backends would catch one that doesn't
+    def select(self, selector):
+        element = self.element
+        return [
+            LxmlNode(match)
+            for match in compile_selector(selector)(element)
+            if not match is element
+        ]
+
+
+def parse_lxml_html(page_source):
+    return LxmlNode(
+        html.document_fromstring(
+            page_source.encode("UTF-8"), parser=html.HTMLParser(encoding="UTF-8")
+        )
+    )
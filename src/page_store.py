@@ -0,0 +1,418 @@
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from itertools import repeat
+from multiprocessing import get_context
+from os import (
+    close,
+    cpu_count,
+    fsync,
+    open as open_file,
+    O_RDONLY,
+    path,
+    pread,
+    stat,
+)
+from src.utilities import clean_html, get_filenames, maybe_create
+from threading import Lock
+from time import time
+import zlib
+
+# zstandard compresses better and faster, but it's optional
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# maps each ASIN to where its page is in the segment files
+INDEX_FILE = "index.tsv"
+
+# start a new segment file once the current one gets this big
+SEGMENT_SIZE = 256 * 1024 * 1024
+
+ZLIB_CODEC = "zlib"
+ZSTD_CODEC = "zstd"
+
+
+def compress(page_bytes):
+    if zstandard is None:
+        return ZLIB_CODEC, zlib.compress(page_bytes, 6)
+    return ZSTD_CODEC, zstandard.ZstdCompressor(level=6).compress(page_bytes)
+
+
+def decompress(codec, compressed):
+    if codec == ZSTD_CODEC:
+        return zstandard.ZstdDecompressor().decompress(compressed)
+    return zlib.decompress(compressed)
+
+
+def get_segment_file(store_folder, segment_number):
+    return path.join(store_folder, "segment_{0:05d}.pages".format(segment_number))
+
+
+def parse_capture_time(capture_time_text):
+    if capture_time_text == "":
+        return None
+    return float(capture_time_text)
+
+
+def format_capture_time(capture_time):
+    if capture_time is None:
+        return ""
+    return repr(capture_time)
+
+
+# one prettified html file per ASIN, like we've always done
+class FolderPageStore:
+    def __init__(self, folder):
+        self.folder = folder
+
+    def get_file(self, ASIN):
+        return path.join(self.folder, ASIN + ".html")
+
+    def ASINs(self):
+        return get_filenames(self.folder)
+
+    def read(self, ASIN):
+        with open(self.get_file(ASIN), "r", encoding="UTF-8") as io:
+            return io.read()
+
+    def serialize(self, soup):
+        return soup.prettify()
+
+    def write_text(self, ASIN, text, capture_time=None):
+        with open(self.get_file(ASIN), "w", encoding="UTF-8") as io:
+            io.write(text)
+
+    def write(self, ASIN, soup):
+        self.write_text(ASIN, self.serialize(soup))
+
+    # we don't keep track of when loose pages were captured
+    # but they can't have been captured after they were written
+    def get_capture_time(self, ASIN):
+        return stat(self.get_file(ASIN)).st_mtime
+
+    # a cheap check for whether a page has changed
+    def get_stamp(self, ASIN):
+        file_stats = stat(self.get_file(ASIN))
+        return (file_stats.st_mtime_ns, file_stats.st_size)
+
+    def get_hash(self, ASIN):
+        with open(self.get_file(ASIN), "rb") as io:
+            return sha256(io.read()).hexdigest()
+
+
+# compressed pages packed into a few big segment files
+# identical pages are only stored once
+class PackedPageStore:
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = Lock()
+        # ASIN: (content hash, segment number, offset, length, codec, capture time)
+        self.locations = {}
+        # content hash: (segment number, offset, length, codec)
+        self.hash_locations = {}
+        # only open the segments we actually read from
+        self.read_descriptors = {}
+        self.segment_number = 0
+        self.segment_size = 0
+        index_file = path.join(folder, INDEX_FILE)
+        # if we crashed in the middle of a line, start the next one on a new line
+        self.index_ends_cleanly = True
+        with open(index_file, "r", encoding="UTF-8") as io:
+            for line in io:
+                self.index_ends_cleanly = line.endswith("\n")
+                fields = line.rstrip("\n").split("\t")
+                # older indices don't have a capture time
+                if len(fields) == 6:
+                    fields.append("")
+                # skip a line cut off by a crash
+                if len(fields) != 7:
+                    continue
+                (
+                    ASIN,
+                    content_hash,
+                    segment_number,
+                    offset,
+                    length,
+                    codec,
+                    capture_time,
+                ) = fields
+                location = (int(segment_number), int(offset), int(length), codec)
+                # later lines replace earlier ones
+                self.locations[ASIN] = (
+                    (content_hash,) + location + (parse_capture_time(capture_time),)
+                )
+                self.hash_locations[content_hash] = location
+                self.segment_number = max(self.segment_number, location[0])
+
+        segment_file = get_segment_file(folder, self.segment_number)
+        if path.isfile(segment_file):
+            self.segment_size = stat(segment_file).st_size
+        self.index_io = None
+        self.segment_io = None
+
+    def ASINs(self):
+        return list(self.locations.keys())
+
+    def read(self, ASIN):
+        (_, segment_number, offset, length, codec, _) = self.locations[ASIN]
+        # threads share the descriptors, so only open each one once
+        with self.lock:
+            descriptor = self.read_descriptors.get(segment_number)
+            if descriptor is None:
+                descriptor = open_file(
+                    get_segment_file(self.folder, segment_number), O_RDONLY
+                )
+                self.read_descriptors[segment_number] = descriptor
+        # pread doesn't share a file position, so it's safe across threads and processes
+        return decompress(codec, pread(descriptor, length, offset)).decode("UTF-8")
+
+    # whitespace is already stripped, so don't prettify
+    def serialize(self, soup):
+        return str(soup)
+
+    def write(self, ASIN, soup):
+        self.write_text(ASIN, self.serialize(soup))
+
+    def write_text(self, ASIN, text, capture_time=None):
+        page_bytes = text.encode("UTF-8")
+        content_hash = sha256(page_bytes).hexdigest()
+        with self.lock:
+            location = self.hash_locations.get(content_hash)
+            if location is None:
+                (codec, compressed) = compress(page_bytes)
+                if self.segment_io is None or self.segment_size >= SEGMENT_SIZE:
+                    self.start_segment()
+                location = (
+                    self.segment_number,
+                    self.segment_size,
+                    len(compressed),
+                    codec,
+                )
+                self.segment_io.write(compressed)
+                self.segment_io.flush()
+                self.segment_size = self.segment_size + len(compressed)
+                self.hash_locations[content_hash] = location
+
+            # write the page before the index, so the index never points at nothing
+            if self.index_io is None:
+                self.index_io = open(
+                    path.join(self.folder, INDEX_FILE), "a", encoding="UTF-8"
+                )
+                if not self.index_ends_cleanly:
+                    self.index_io.write("\n")
+                    self.index_ends_cleanly = True
+            self.index_io.write(
+                "\t".join(
+                    [ASIN, content_hash]
+                    + [str(field) for field in location]
+                    + [format_capture_time(capture_time)]
+                )
+                + "\n"
+            )
+            self.index_io.flush()
+            self.locations[ASIN] = (content_hash,) + location + (capture_time,)
+
+    def start_segment(self):
+        if not self.segment_io is None:
+            self.segment_io.close()
+        if self.segment_size >= SEGMENT_SIZE:
+            self.segment_number = self.segment_number + 1
+            self.segment_size = 0
+        self.segment_io = open(get_segment_file(self.folder, self.segment_number), "ab")
+
+    # where the page is changes whenever the page changes
+    def get_stamp(self, ASIN):
+        return self.locations[ASIN][1:]
+
+    def get_hash(self, ASIN):
+        return self.locations[ASIN][0]
+
+    def get_capture_time(self, ASIN):
+        return self.locations[ASIN][5]
+
+    def close(self):
+        with self.lock:
+            for io in (self.segment_io, self.index_io):
+                if not io is None:
+                    io.flush()
+                    fsync(io.fileno())
+                    io.close()
+            self.segment_io = None
+            self.index_io = None
+            for descriptor in self.read_descriptors.values():
+                close(descriptor)
+            self.read_descriptors = {}
+
+
+# where we got each page from
+# pages fetched over plain http don't have a fakespot grade, so a browser still needs to visit them
+HTTP_SOURCE = "http"
+BROWSER_SOURCE = "browser"
+
+
+# an append-only log of the source of each page we save, one ASIN and source per line
+# the last line for an ASIN wins
+class PageSources:
+    def __init__(self, sources_file):
+        self.lock = Lock()
+        # ASIN: source
+        self.sources = {}
+        # if we crashed in the middle of a line, start the next one on a new line
+        ends_cleanly = True
+        if path.isfile(sources_file):
+            with open(sources_file, "r", encoding="UTF-8") as io:
+                for line in io:
+                    ends_cleanly = line.endswith("\n")
+                    fields = line.rstrip("\n").split("\t")
+                    # skip a line cut off by a crash
+                    if len(fields) != 2 or not fields[1] in (HTTP_SOURCE, BROWSER_SOURCE):
+                        continue
+                    (ASIN, source) = fields
+                    self.sources[ASIN] = source
+        self.io = open(sources_file, "a", encoding="UTF-8")
+        if not ends_cleanly:
+            self.io.write("\n")
+
+    def add(self, ASIN, source):
+        with self.lock:
+            self.io.write(ASIN + "\t" + source + "\n")
+            self.io.flush()
+            fsync(self.io.fileno())
+            self.sources[ASIN] = source
+
+    # saved over http, and not by a browser since
+    def needs_grade(self):
+        with self.lock:
+            return set(
+                ASIN for ASIN, source in self.sources.items() if source == HTTP_SOURCE
+            )
+
+    def close(self):
+        self.io.close()
+
+
+# share one store per folder within each process
+PAGE_STORES = {}
+
+
+# folders with an index are packed, otherwise they are loose html files
+def get_page_store(folder):
+    page_store = PAGE_STORES.get(folder)
+    if page_store is None:
+        if path.isfile(path.join(folder, INDEX_FILE)):
+            page_store = PackedPageStore(folder)
+        else:
+            page_store = FolderPageStore(folder)
+        PAGE_STORES[folder] = page_store
+    return page_store
+
+
+def create_packed_page_store(folder):
+    maybe_create(folder)
+    index_file = path.join(folder, INDEX_FILE)
+    if not path.isfile(index_file):
+        open(index_file, "w", encoding="UTF-8").close()
+    # forget any loose store we opened before
+    if not isinstance(PAGE_STORES.get(folder), PackedPageStore):
+        PAGE_STORES.pop(folder, None)
+    return get_page_store(folder)
+
+
+# clean the page and write it to the store for the folder
+def save_page_source(pages_folder, ASIN, page_source):
+    get_page_store(pages_folder).write(ASIN, clean_html(page_source))
+
+
+# the CPU-bound half of save_page_source, to run in another process
+def clean_page_source(pages_folder, ASIN, page_source):
+    return (ASIN, get_page_store(pages_folder).serialize(clean_html(page_source)))
+
+
+# the writing half of save_page_source, once cleaning is done
+def write_cleaned_page(pages_folder, cleaned_page_future):
+    (ASIN, text) = cleaned_page_future.result()
+    get_page_store(pages_folder).write_text(ASIN, text)
+
+
+def read_page_source(pages_folder, ASIN):
+    return get_page_store(pages_folder).read(ASIN)
+
+
+# copy loose html files into a packed store
+def pack_page_folder(pages_folder, store_folder):
+    folder_store = FolderPageStore(pages_folder)
+    packed_store = create_packed_page_store(store_folder)
+    for ASIN in folder_store.ASINs():
+        if not ASIN in packed_store.locations:
+            # the files are already clean, so this just strips the prettified whitespace
+            packed_store.write(ASIN, clean_html(folder_store.read(ASIN)))
+    packed_store.close()
+
+
+# save the page exactly as the browser had it, to clean later
+# this keeps cleaning off the browser thread, and lets us clean again with new junk selectors
+# call create_packed_page_store first, once
+def save_raw_page_source(raw_pages_folder, ASIN, page_source):
+    get_page_store(raw_pages_folder).write_text(
+        ASIN, page_source, capture_time=time()
+    )
+
+
+# ASINs = raw_page_store.ASINs()[0:10]
+def clean_raw_chunk(raw_pages_folder, pages_folder, ASINs):
+    raw_page_store = get_page_store(raw_pages_folder)
+    page_store = get_page_store(pages_folder)
+    return [
+        (ASIN, page_store.serialize(clean_html(raw_page_store.read(ASIN))))
+        for ASIN in ASINs
+    ]
+
+
+# how many pages each process cleans at a time
+CLEAN_CHUNK_SIZE = 100
+
+
+# clean raw pages that are new, or were captured again since we last cleaned them
+# reclean everything after changing the junk selectors
+def clean_raw_pages(
+    raw_pages_folder, pages_folder, processes=cpu_count(), reclean=False
+):
+    raw_page_store = create_packed_page_store(raw_pages_folder)
+    page_store = get_page_store(pages_folder)
+    cleaned_ASINs = set(page_store.ASINs())
+    ASINs = []
+    for ASIN in raw_page_store.ASINs():
+        if reclean or not ASIN in cleaned_ASINs:
+            ASINs.append(ASIN)
+            continue
+        cleaned_capture_time = page_store.get_capture_time(ASIN)
+        raw_capture_time = raw_page_store.get_capture_time(ASIN)
+        # if we don't know when we cleaned it, clean it again to be safe
+        if cleaned_capture_time is None or (
+            not raw_capture_time is None and raw_capture_time > cleaned_capture_time
+        ):
+            ASINs.append(ASIN)
+
+    print("Cleaning {0:d} raw pages".format(len(ASINs)))
+    # flush what we've captured, so the other processes can read it
+    raw_page_store.close()
+    # run_stages can start lucene's JVM on another thread, which isn't safe to fork
+    with ProcessPoolExecutor(processes, mp_context=get_context("spawn")) as executor:
+        # only this process writes, so the store doesn't get mixed up
+        for cleaned_pages in executor.map(
+            clean_raw_chunk,
+            repeat(raw_pages_folder),
+            repeat(pages_folder),
+            [
+                ASINs[index : index + CLEAN_CHUNK_SIZE]
+                for index in range(0, len(ASINs), CLEAN_CHUNK_SIZE)
+            ],
+        ):
+            for ASIN, text in cleaned_pages:
+                page_store.write_text(
+                    ASIN, text, raw_page_store.get_capture_time(ASIN)
+                )
+
+    if isinstance(page_store, PackedPageStore):
+        page_store.close()
@@ -0,0 +1,112 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os import cpu_count
+from queue import Queue
+from threading import BoundedSemaphore, Event, Lock, Thread
+from time import perf_counter
+
+# how many pages can wait to be processed, per process
+PAGES_PER_PROCESS = 4
+
+# report the queue depths after this many pages
+REPORT_EVERY = 100
+
+
+# browser threads only navigate, and hand off the html
+# a process pool does the CPU work of cleaning and parsing
+# and a writer thread saves the results, one at a time and in order
+class PagePipeline:
+    def __init__(
+        self,
+        processes=cpu_count(),
+        pages_per_process=PAGES_PER_PROCESS,
+        report_every=REPORT_EVERY,
+    ):
+        # processes start while selenium threads are running, and maybe lucene's JVM, which aren't safe to fork
+        self.executor = ProcessPoolExecutor(processes, mp_context=get_context("spawn"))
+        self.queue_size = processes * pages_per_process
+        # browsers wait here if the processes fall behind
+        self.slots = BoundedSemaphore(self.queue_size)
+        self.write_queue = Queue()
+        self.report_every = report_every
+        self.lock = Lock()
+        self.submitted = 0
+        self.in_progress = 0
+        self.written = 0
+        self.failed = 0
+        self.backpressure_time = 0.0
+        self.writer = Thread(target=self.write_all)
+        self.writer.start()
+
+    def finish_page(self, future):
+        with self.lock:
+            self.in_progress = self.in_progress - 1
+        self.slots.release()
+
+    # returns a future for the result
+    def submit(self, function, *arguments):
+        start_time = perf_counter()
+        self.slots.acquire()
+        with self.lock:
+            self.backpressure_time = (
+                self.backpressure_time + perf_counter() - start_time
+            )
+            self.submitted = self.submitted + 1
+            self.in_progress = self.in_progress + 1
+            submitted = self.submitted
+        future = self.executor.submit(function, *arguments)
+        future.add_done_callback(self.finish_page)
+        if submitted % self.report_every == 0:
+            self.report()
+        return future
+
+    # the writer thread runs these in the order they were added
+    # writers can wait for the results of submitted futures
+    def write(self, function, *arguments):
+        self.write_queue.put((function, arguments))
+
+    # wait until everything written so far has been written
+    def flush(self):
+        flushed = Event()
+        self.write_queue.put(flushed)
+        flushed.wait()
+
+    def write_all(self):
+        while True:
+            task = self.write_queue.get()
+            # we're done
+            if task is None:
+                return
+            # someone is waiting for the writes before this
+            if isinstance(task, Event):
+                task.set()
+                continue
+            (function, arguments) = task
+            try:
+                function(*arguments)
+                with self.lock:
+                    self.written = self.written + 1
+            except Exception as exception:
+                # one bad page shouldn't stop the whole pipeline
+                print("Error in {0}: {1}".format(function.__name__, repr(exception)))
+                with self.lock:
+                    self.failed = self.failed + 1
+
+    def report(self):
+        print(
+            "{0:d} pages submitted, {1:d}/{2:d} processing, {3:d} waiting to write, {4:d} written, {5:d} failed, {6:.1f}s waiting on processes".format(
+                self.submitted,
+                self.in_progress,
+                self.queue_size,
+                self.write_queue.qsize(),
+                self.written,
+                self.failed,
+                self.backpressure_time,
+            )
+        )
+
+    def close(self):
+        self.write_queue.put(None)
+        self.writer.join()
+        self.executor.shutdown(wait=True)
+        self.report()
@@ -1,10 +1,26 @@
-from os import path
-from pandas import concat, DataFrame
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import get_context
+from numpy import array_split
+from os import cpu_count, path, replace
+import pickle
 import re
+from src.field_extractor import (
+    ALL,
+    always_true,
+    FieldExtractor,
+    FieldSpec,
+    FIRST,
+    get_text,
+    ONLY,
+)
+from src.lxml_backend import parse_lxml_html
+from src.page_store import get_page_store, read_page_source
+from src.schemas import get_columns, PRODUCT_SCHEMA
 from src.utilities import (
-    get_filenames,
     only,
-    read_html,
+    parse_html,
+    RowAccumulator,
     strict_match,
 )
 import webbrowser
@@ -114,7 +130,7 @@ def parse_list_price(pricebox):
 
 
 # ASIN = "Fossil-Quartz-Stainless-Steel-ChronographdpB009LSKPYIrefsr_1_51keywordswatchesformenqid1684247239sr8-51"
-# product_page = read_html(path.join(product_pages_folder, ASIN + ".html"))
+# product_page = parse_html(read_page_source(product_pages_folder, ASIN))
 # best_seller_link = product_page.select("div#detailBulletsWrapper_feature_div a[href*='/gp/bestsellers/']")[0]
 def parse_best_seller_link(
     best_seller_link, skip_header=False
@@ -168,16 +184,75 @@ def parse_coupon(promo_widget):
     return (coupon_amount, coupon_percent, subscribe_coupon)
 
 
+def has_limited_stock(availability_widget):
+    return not re.search(r"Only ([\d\,]+) left in stock", availability_widget.text) is None
+
+
+def mentions_amazon(widget):
+    return "Amazon" in widget.text
+
+
+# widgets in the buybox, found in one walk through the buybox
+BUYBOX_EXTRACTOR = FieldExtractor(
+    [
+        # price and unit price
+        FieldSpec("price_pair_widget", "div#corePrice_feature_div", ONLY),
+        FieldSpec(
+            "free_prime_shipping",
+            "span#price-shipping-message",
+            ONLY,
+            always_true,
+            False,
+        ),
+        FieldSpec(
+            "limited_stock",
+            "div[data-csa-c-content-id='desktop_buybox_group_1'] div#availability > span:first-of-type",
+            ONLY,
+            has_limited_stock,
+            False,
+        ),
+        FieldSpec(
+            "free_returns", "a#creturns-policy-anchor-text", ONLY, always_true, False
+        ),
+        FieldSpec(
+            "standard_shipping_widget",
+            "div#mir-layout-DELIVERY_BLOCK-slot-PRIMARY_DELIVERY_MESSAGE_LARGE > span[data-csa-c-content-id*='DEXUnified']",
+            ONLY,
+        ),
+        FieldSpec(
+            "rush_shipping_available",
+            "div#mir-layout-DELIVERY_BLOCK-slot-SECONDARY_DELIVERY_MESSAGE_LARGE span.a-text-bold",
+            ONLY,
+            always_true,
+            False,
+        ),
+        FieldSpec(
+            "ships_from_amazon",
+            "div.tabular-buybox-text[tabular-attribute-name='Ships from']",
+            ONLY,
+            mentions_amazon,
+            False,
+        ),
+        FieldSpec(
+            "sold_by_amazon",
+            "div.tabular-buybox-text[tabular-attribute-name='Sold by']",
+            ONLY,
+            mentions_amazon,
+            False,
+        ),
+        FieldSpec(
+            "returns",
+            "div.tabular-buybox-text[tabular-attribute-name='Returns'] span.tabular-buybox-text-message",
+            ALL,
+            bool,
+        ),
+    ]
+)
+
+
 def parse_buybox(buybox, current_year):
     # add defaults for all our variables
-    free_prime_shipping = False
-    free_returns = False
-    limited_stock = False
     price = None
-    returns = False
-    rush_shipping_available = False
-    ships_from_amazon = False
-    sold_by_amazon = False
     standard_shipping_conditional = False
     standard_shipping_cost = None
     standard_shipping_date_start = None
@@ -185,10 +260,11 @@ def parse_buybox(buybox, current_year):
     unit = "Purchase"
     unit_price = None
 
+    buybox_fields = BUYBOX_EXTRACTOR.extract(buybox)
+
     # price and unit price
-    price_pair_widgets = buybox.select("div#corePrice_feature_div")
-    if price_pair_widgets:
-        price_pair_widget = only(price_pair_widgets)
+    price_pair_widget = buybox_fields["price_pair_widget"]
+    if not price_pair_widget is None:
         price_widgets = price_pair_widget.select("span.a-offscreen")
         number_of_prices = len(price_widgets)
         if number_of_prices >= 1:
@@ -212,28 +288,12 @@ def parse_buybox(buybox, current_year):
         if number_of_prices >= 3:
             raise NotOneOrTwoPrices(number_of_prices)
 
-    free_prime_shipping_widgets = buybox.select("span#price-shipping-message")
-    if free_prime_shipping_widgets:
-        only(free_prime_shipping_widgets)
-        free_prime_shipping = True
-
-    availability_widgets = buybox.select(
-        "div[data-csa-c-content-id='desktop_buybox_group_1'] div#availability > span:first-of-type"
-    )
-    if availability_widgets:
-        if re.search(r"Only ([\d\,]+) left in stock", only(availability_widgets).text):
-            limited_stock = True
-
-    free_returns_widgets = buybox.select("a#creturns-policy-anchor-text")
-    if free_returns_widgets:
-        only(free_returns_widgets)
-        free_returns = True
+    free_prime_shipping = buybox_fields["free_prime_shipping"]
+    limited_stock = buybox_fields["limited_stock"]
+    free_returns = buybox_fields["free_returns"]
 
-    standard_shipping_widgets = buybox.select(
-        "div#mir-layout-DELIVERY_BLOCK-slot-PRIMARY_DELIVERY_MESSAGE_LARGE > span[data-csa-c-content-id*='DEXUnified']"
-    )
-    if standard_shipping_widgets:
-        standard_shipping_widget = only(standard_shipping_widgets)
+    standard_shipping_widget = buybox_fields["standard_shipping_widget"]
+    if not standard_shipping_widget is None:
         (standard_shipping_date_start, standard_shipping_date_end) = parse_dates(
             standard_shipping_widget["data-csa-c-delivery-time"], current_year
         )
@@ -247,27 +307,10 @@ def parse_buybox(buybox, current_year):
         if standard_shipping_widget["data-csa-c-delivery-condition"] != "":
             standard_shipping_conditional = True
 
-    rush_shipping_widgets = buybox.select("div#mir-layout-DELIVERY_BLOCK-slot-SECONDARY_DELIVERY_MESSAGE_LARGE span.a-text-bold")
-    if rush_shipping_widgets:
-        only(rush_shipping_widgets)
-        rush_shipping_available = True
-
-    ships_from_widgets = buybox.select(
-        "div.tabular-buybox-text[tabular-attribute-name='Ships from']"
-    )
-    if ships_from_widgets:
-        ships_from_amazon = "Amazon" in only(ships_from_widgets).text
-
-    sold_by_widgets = buybox.select(
-        "div.tabular-buybox-text[tabular-attribute-name='Sold by']"
-    )
-    if sold_by_widgets:
-        sold_by_amazon = "Amazon" in only(sold_by_widgets).text
-
-    if buybox.select(
-        "div.tabular-buybox-text[tabular-attribute-name='Returns'] span.tabular-buybox-text-message"
-    ):
-        returns = True
+    rush_shipping_available = buybox_fields["rush_shipping_available"]
+    ships_from_amazon = buybox_fields["ships_from_amazon"]
+    sold_by_amazon = buybox_fields["sold_by_amazon"]
+    returns = buybox_fields["returns"]
 
     return {
         "free_prime_shipping": free_prime_shipping,
@@ -286,22 +329,125 @@ def parse_buybox(buybox, current_year):
         "unit": unit,
     }
 
-# product_rows = []
-# ASIN = get_filenames(product_pages_folder)[0]
+
+# ways to read product pages
+# the lxml backend skips building a BeautifulSoup tree
+SOUP_BACKEND = "soup"
+LXML_BACKEND = "lxml"
+HTML_PARSERS = {
+    SOUP_BACKEND: parse_html,
+    LXML_BACKEND: parse_lxml_html,
+}
+
+
+# columns of the product data, in order
+PRODUCT_COLUMNS = get_columns(PRODUCT_SCHEMA)
+
+
+def get_department(department_widget):
+    return department_widget["class"][0]
+
+
+def parse_answered_questions(answered_questions_widget):
+    answered_questions_text = remove_commas(answered_questions_widget.text)
+    # won't show more than 1000
+    if answered_questions_text == "1000+ answered questions":
+        return 1000
+    return int(
+        strict_match(
+            r"([\d]+) answered questions",
+            answered_questions_text,
+        ).group(1)
+    )
+
+
+# widgets on the whole product page, found in one walk through the page
+PRODUCT_PAGE_EXTRACTOR = FieldExtractor(
+    [
+        FieldSpec("unsupported_text", "h2.heading.title", ONLY, get_text),
+        FieldSpec(
+            "consider_alternatives",
+            "div#percolate-ui-lpo_div",
+            ONLY,
+            always_true,
+            False,
+        ),
+        FieldSpec("department", "div#dp", ONLY, get_department),
+        # just get the broadest category
+        FieldSpec(
+            "category", "div#wayfinding-breadcrumbs_feature_div a", FIRST, get_text, ""
+        ),
+        FieldSpec(
+            "answered_questions",
+            "a#askATFLink span.a-size-base",
+            ONLY,
+            parse_answered_questions,
+            0,
+        ),
+        FieldSpec(
+            "amazons_choice", "div#acBadge_feature_div", ONLY, always_true, False
+        ),
+        FieldSpec(
+            "climate_friendly", "div#climatePledgeFriendly", ONLY, always_true, False
+        ),
+        FieldSpec(
+            "small_business",
+            "div.provenance-certifications-row img[src='https://m.media-amazon.com/images/I/111mHoVK0kL._AC_UL34_SS42_.png']",
+            ONLY,
+            always_true,
+            False,
+        ),
+        FieldSpec("center_pricebox", "div#apex_desktop", ONLY),
+        FieldSpec("promo_widget", "div#promoPriceBlockMessage_feature_div", ONLY),
+        FieldSpec(
+            "table_best_seller_link",
+            "div#prodDetails a[href*='/gp/bestsellers']",
+            FIRST,
+        ),
+        FieldSpec(
+            "bullet_best_seller_link",
+            "div#detailBulletsWrapper_feature_div a[href*='/gp/bestsellers/']",
+            FIRST,
+        ),
+        FieldSpec("ratings_widget", "span.cr-widget-TitleRatingsHistogram", ONLY),
+        FieldSpec("fakespot_widgets", "div.fakespot-main-grade-box-wrapper"),
+        FieldSpec("fakespot_grade_widgets", "div#fs-letter-grade-box"),
+        FieldSpec("new_seller", "div#fakespot-badge", ONLY, always_true, False),
+        # sometimes there is multiple buyboxes for different options
+        # use the first buybox
+        FieldSpec(
+            "first_buybox", "#buyBoxAccordion > div[id*='AccordionRow']", FIRST
+        ),
+        FieldSpec(
+            "buybox", "div[data-csa-c-content-id='desktop_buybox_group_1']", ONLY
+        ),
+        FieldSpec("subscription_available", "div#snsAccordionRowMiddle", ALL, bool),
+    ]
+)
+
+# widgets in the ratings histogram, found in one walk through the histogram
+RATINGS_EXTRACTOR = FieldExtractor(
+    [
+        FieldSpec("average_ratings_widget", "span[data-hook='rating-out-of-text']", ONLY),
+        FieldSpec("total_review_count_widgets", "[data-hook='total-review-count']"),
+        FieldSpec("histogram_rows", "tr.a-histogram-row"),
+    ]
+)
+
+
+# product_rows = RowAccumulator(PRODUCT_COLUMNS)
+# ASIN = get_page_store(product_pages_folder).ASINs()[0]
 def parse_product_page(
     product_rows,
     product_pages_folder,
     ASIN,
     current_year,
+    backend=SOUP_BACKEND,
 ):
     # add defaults for all our variables
-    answered_questions = 0
-    amazons_choice = False
     average_rating = None
     best_seller_category = ""
     best_seller_rank = None
-    category = ""
-    climate_friendly = False
     coupon_amount = None
     coupon_percent = None
     fakespot_rating = None
@@ -309,20 +455,17 @@ def parse_product_page(
     free_returns = False
     limited_stock = False
     list_price = None
-    new_seller = False
     number_of_ratings = 0
     price = None
     refurbished = False
     returns = False
     rush_shipping_available = False
     ships_from_amazon = False
-    small_business = False
     sold_by_amazon = None
     standard_shipping_conditional = False
     standard_shipping_cost = None
     standard_shipping_date_start = None
     standard_shipping_date_end = None
-    subscription_available = False
     subscribe_coupon = False
     unit = "Purchase"
     unit_price = None
@@ -333,13 +476,15 @@ def parse_product_page(
     four_star_percent = None
     five_star_percent = None
 
-    product_page = read_html(path.join(product_pages_folder, ASIN + ".html"))
+    product_page = HTML_PARSERS[backend](
+        read_page_source(product_pages_folder, ASIN)
+    )
+    product_fields = PRODUCT_PAGE_EXTRACTOR.extract(product_page)
 
     # return without doing anything for a variety of non-standard product pages
-    unsupported_browser_widgets = product_page.select("h2.heading.title")
-    if unsupported_browser_widgets:
+    unsupported_text = product_fields["unsupported_text"]
+    if not unsupported_text is None:
         # this is a non-specific CSS selector, so check the text too
-        unsupported_text = only(unsupported_browser_widgets).text
         if (
             not "Your browser is not supported"
             in unsupported_text
@@ -348,59 +493,24 @@ def parse_product_page(
         return
 
     # can't find the product, so consider alternatives
-    consider_alternative_widgets = product_page.select("div#percolate-ui-lpo_div")
-    if consider_alternative_widgets:
-        only(consider_alternative_widgets)
+    if product_fields["consider_alternatives"]:
         return
 
     # this is heading that contains the product department
     # if the heading is missing, it's not really a product
     # like a link to the Amazon music player, etc.
-    department_widgets = product_page.select("div#dp")
-    if not department_widgets:
+    department = product_fields["department"]
+    if department is None:
         return
 
-    department = only(department_widgets)["class"][0]
+    category = product_fields["category"]
+    answered_questions = product_fields["answered_questions"]
+    amazons_choice = product_fields["amazons_choice"]
+    climate_friendly = product_fields["climate_friendly"]
+    small_business = product_fields["small_business"]
 
-    category_widgets = product_page.select("div#wayfinding-breadcrumbs_feature_div a")
-    if category_widgets:
-        # just get the broadest category
-        category = category_widgets[0].text
-
-    answered_questions_widgets = product_page.select("a#askATFLink span.a-size-base")
-    if answered_questions_widgets:
-        answered_questions_text = remove_commas(only(answered_questions_widgets).text)
-        # won't show more than 1000
-        if answered_questions_text == "1000+ answered questions":
-            answered_questions = 1000
-        else:
-            answered_questions = int(
-                strict_match(
-                    r"([\d]+) answered questions",
-                    remove_commas(only(answered_questions_widgets).text),
-                ).group(1)
-            )
-
-    amazons_choice_widgets = product_page.select("div#acBadge_feature_div")
-    if amazons_choice_widgets:
-        only(amazons_choice_widgets)
-        amazons_choice = True
-
-    climate_friendly_widgets = product_page.select("div#climatePledgeFriendly")
-    if climate_friendly_widgets:
-        only(climate_friendly_widgets)
-        climate_friendly = True
-
-    small_business_widgets = product_page.select(
-        "div.provenance-certifications-row img[src='https://m.media-amazon.com/images/I/111mHoVK0kL._AC_UL34_SS42_.png']"
-    )
-    if small_business_widgets:
-        only(small_business_widgets)
-        small_business = True
-
-    center_priceboxes = product_page.select("div#apex_desktop")
-    if center_priceboxes:
-        center_pricebox = only(center_priceboxes)
+    center_pricebox = product_fields["center_pricebox"]
+    if not center_pricebox is None:
         center_pricebox_sets = center_pricebox.select("div.offersConsistencyEnabled")
         if center_pricebox_sets:
             # the invisible ones will have style='hidden'
@@ -410,9 +520,8 @@ def parse_product_page(
             else:
                 list_price = parse_list_price(center_pricebox)
 
-    promo_widgets = product_page.select("div#promoPriceBlockMessage_feature_div")
-    if promo_widgets:
-        promo_widget = only(promo_widgets)
+    promo_widget = product_fields["promo_widget"]
+    if not promo_widget is None:
         promo_widget_sets = promo_widget.select("div.offersConsistencyEnabled")
         if promo_widget_sets:
             # the invisible ones will have style='hidden'
@@ -426,49 +535,38 @@ def parse_product_page(
                 promo_widget
             )
 
-    table_best_seller_links = product_page.select(
-        "div#prodDetails a[href*='/gp/bestsellers']"
-    )
-
-    if len(table_best_seller_links) > 0:
+    table_best_seller_link = product_fields["table_best_seller_link"]
+    if not table_best_seller_link is None:
         # table details
         best_seller_category, best_seller_rank = parse_best_seller_link(
-            table_best_seller_links[0]
+            table_best_seller_link
         )
     else:
-        bullet_best_seller_links = product_page.select(
-            "div#detailBulletsWrapper_feature_div a[href*='/gp/bestsellers/']"
-        )
-        if bullet_best_seller_links:
+        bullet_best_seller_link = product_fields["bullet_best_seller_link"]
+        if not bullet_best_seller_link is None:
             best_seller_category, best_seller_rank = parse_best_seller_link(
-                bullet_best_seller_links[0], True
+                bullet_best_seller_link, True
             )
 
-    ratings_widgets = product_page.select("span.cr-widget-TitleRatingsHistogram")
-    if ratings_widgets:
-        ratings_widget = only(ratings_widgets)
-        average_ratings_widgets = ratings_widget.select(
-            "span[data-hook='rating-out-of-text']"
-        )
-        if average_ratings_widgets:
+    ratings_widget = product_fields["ratings_widget"]
+    if not ratings_widget is None:
+        ratings_fields = RATINGS_EXTRACTOR.extract(ratings_widget)
+        average_ratings_widget = ratings_fields["average_ratings_widget"]
+        if not average_ratings_widget is None:
             average_rating = float(
                 strict_match(
-                    r"([\d\.\,]+) out of 5", only(average_ratings_widgets).text
+                    r"([\d\.\,]+) out of 5", average_ratings_widget.text
                 ).group(1)
             )
             number_of_ratings = int(
                 strict_match(
                     r"([\d,]+) global ratings?",
                     remove_commas(
-                        only(
-                            ratings_widget.select(
-                                "[data-hook='total-review-count']",
-                            )
-                        ).text
+                        only(ratings_fields["total_review_count_widgets"]).text
                     ),
                 ).group(1)
             )
-            histogram_rows = ratings_widget.select("tr.a-histogram-row")
+            histogram_rows = ratings_fields["histogram_rows"]
             number_of_histogram_rows = len(histogram_rows)
             if len(histogram_rows) != 5:
                 raise NotFiveRows(number_of_histogram_rows)
@@ -479,21 +577,18 @@ def parse_product_page(
             two_star_percent = get_star_percent(histogram_rows[3])
             one_star_percent = get_star_percent(histogram_rows[4])
 
-    fakespot_widgets = product_page.select("div.fakespot-main-grade-box-wrapper")
-    if fakespot_widgets:
-        fakespot_rating = only(product_page.select("div#fs-letter-grade-box")).text
+    if product_fields["fakespot_widgets"]:
+        fakespot_rating = only(product_fields["fakespot_grade_widgets"]).text
 
-    new_seller_widgets = product_page.select("div#fakespot-badge")
-    if new_seller_widgets:
-        only(new_seller_widgets)
-        new_seller = True
+    new_seller = product_fields["new_seller"]
 
     # box on the right where you buy the product
-    # sometimes there is multiple buyboxes for different options
-    buybox_sets = product_page.select("#buyBoxAccordion > div[id*='AccordionRow']")
-    if buybox_sets:
-        # use the first buybox
-        buybox_data = parse_buybox(buybox_sets[0], current_year)
+    buybox = product_fields["first_buybox"]
+    if buybox is None:
+        buybox = product_fields["buybox"]
+
+    if not buybox is None:
+        buybox_data = parse_buybox(buybox, current_year)
         free_prime_shipping = buybox_data["free_prime_shipping"]
         free_returns = buybox_data["free_returns"]
         limited_stock = buybox_data["limited_stock"]
@@ -508,30 +603,8 @@ def parse_product_page(
         standard_shipping_date_end = buybox_data["standard_shipping_date_end"]
         unit_price = buybox_data["unit_price"]
         unit = buybox_data["unit"]
-    else:
-        buyboxes = product_page.select(
-            "div[data-csa-c-content-id='desktop_buybox_group_1']"
-        )
-        if buyboxes:
-            buybox_data = parse_buybox(only(buyboxes), current_year)
-            free_prime_shipping = buybox_data["free_prime_shipping"]
-            free_returns = buybox_data["free_returns"]
-            limited_stock = buybox_data["limited_stock"]
-            price = buybox_data["price"]
-            returns = buybox_data["returns"]
-            rush_shipping_available = buybox_data["rush_shipping_available"]
-            ships_from_amazon = buybox_data["ships_from_amazon"]
-            sold_by_amazon = buybox_data["sold_by_amazon"]
-            standard_shipping_conditional = buybox_data["standard_shipping_conditional"]
-            standard_shipping_cost = buybox_data["standard_shipping_cost"]
-            standard_shipping_date_start = buybox_data["standard_shipping_date_start"]
-            standard_shipping_date_end = buybox_data["standard_shipping_date_end"]
-            unit_price = buybox_data["unit_price"]
-            unit = buybox_data["unit"]
-
-    subscription_widgets = product_page.select("div#snsAccordionRowMiddle")
-    if subscription_widgets:
-        subscription_available = True
+
+    subscription_available = product_fields["subscription_available"]
 
     # if no list price, assume the list price is the price
     if list_price is None:
@@ -547,64 +620,248 @@ def parse_product_page(
             coupon_amount = 0.0
 
     product_rows.append(
-        DataFrame(
-            {
-                "answered_questions": [answered_questions],
-                "amazons_choice": [amazons_choice],
-                "average_rating": [average_rating],
-                "best_seller_rank": [best_seller_rank],
-                "best_seller_category": [best_seller_category],
-                "category": [category],
-                "climate_friendly": [climate_friendly],
-                "coupon_amount": [coupon_amount],
-                "fakespot_rating": [fakespot_rating],
-                "free_prime_shipping": [free_prime_shipping],
-                "free_returns": [free_returns],
-                "limited_stock": [limited_stock],
-                "list_price": [list_price],
-                "ASIN": [ASIN],
-                "new_seller": [new_seller],
-                "number_of_ratings": [number_of_ratings],
-                "price": [price],
-                "department": [department],
-                "refurbished": [refurbished],
-                "returns": [returns],
-                "rush_shipping_available": [rush_shipping_available],
-                "ships_from_amazon": [ships_from_amazon],
-                "small_business": [small_business],
-                "sold_by_amazon": [sold_by_amazon],
-                "standard_shipping_cost": [standard_shipping_cost],
-                "standard_shipping_conditional": [standard_shipping_conditional],
-                "standard_shipping_date_start": [standard_shipping_date_start],
-                "standard_shipping_date_end": [standard_shipping_date_end],
-                "subscribe_coupon": [subscribe_coupon],
-                "subscription_available": [subscription_available],
-                "unit": [unit],
-                "unit_price": [unit_price],
-                "one_star_percent": [one_star_percent],
-                "two_star_percent": [two_star_percent],
-                "three_star_percent": [three_star_percent],
-                "four_star_percent": [four_star_percent],
-                "five_star_percent": [five_star_percent],
-            },
-        )
+        {
+            "answered_questions": answered_questions,
+            "amazons_choice": amazons_choice,
+            "average_rating": average_rating,
+            "best_seller_rank": best_seller_rank,
+            "best_seller_category": best_seller_category,
+            "category": category,
+            "climate_friendly": climate_friendly,
+            "coupon_amount": coupon_amount,
+            "fakespot_rating": fakespot_rating,
+            "free_prime_shipping": free_prime_shipping,
+            "free_returns": free_returns,
+            "limited_stock": limited_stock,
+            "list_price": list_price,
+            "ASIN": ASIN,
+            "new_seller": new_seller,
+            "number_of_ratings": number_of_ratings,
+            "price": price,
+            "department": department,
+            "refurbished": refurbished,
+            "returns": returns,
+            "rush_shipping_available": rush_shipping_available,
+            "ships_from_amazon": ships_from_amazon,
+            "small_business": small_business,
+            "sold_by_amazon": sold_by_amazon,
+            "standard_shipping_cost": standard_shipping_cost,
+            "standard_shipping_conditional": standard_shipping_conditional,
+            "standard_shipping_date_start": standard_shipping_date_start,
+            "standard_shipping_date_end": standard_shipping_date_end,
+            "subscribe_coupon": subscribe_coupon,
+            "subscription_available": subscription_available,
+            "unit": unit,
+            "unit_price": unit_price,
+            "one_star_percent": one_star_percent,
+            "two_star_percent": two_star_percent,
+            "three_star_percent": three_star_percent,
+            "four_star_percent": four_star_percent,
+            "five_star_percent": five_star_percent,
+        }
     )
 
 # current_year = "CURRENT_YEAR"
-def parse_product_pages(product_pages_folder, current_year):
-    product_rows = []
-    # ASIN = get_filenames(product_pages_folder)[0]
-    for ASIN in get_filenames(product_pages_folder):
+def parse_product_pages(product_pages_folder, current_year, backend=SOUP_BACKEND):
+    product_rows = RowAccumulator(PRODUCT_COLUMNS)
+    # ASIN = get_page_store(product_pages_folder).ASINs()[0]
+    for ASIN in get_page_store(product_pages_folder).ASINs():
         try:
             parse_product_page(
                 product_rows,
                 product_pages_folder,
                 ASIN,
                 current_year,
+                backend,
             )
         except Exception as exception:
             print("Error: ", ASIN)
-            webbrowser.open(path.join(product_pages_folder, ASIN + ".html"))
+            # packed pages don't have their own file to look at
+            file = path.join(product_pages_folder, ASIN + ".html")
+            if path.isfile(file):
+                webbrowser.open(file)
             raise exception
 
-    return concat(product_rows)
+    return product_rows.to_data_frame()
+
+
+# ASINs = get_page_store(product_pages_folder).ASINs()[0:10]
+def parse_product_chunk(product_pages_folder, ASINs, current_year, backend):
+    product_rows = RowAccumulator(PRODUCT_COLUMNS)
+    errors = []
+    for ASIN in ASINs:
+        # report errors per ASIN instead of stopping the whole run
+        try:
+            parse_product_page(
+                product_rows,
+                product_pages_folder,
+                ASIN,
+                current_year,
+                backend,
+            )
+        except Exception as exception:
+            errors.append((ASIN, repr(exception)))
+
+    return product_rows, errors
+
+
+# more chunks than processes, so a slow chunk doesn't hold up the others
+CHUNKS_PER_PROCESS = 4
+
+
+# ASINs = sorted(get_page_store(product_pages_folder).ASINs())
+def multiprocess_parse_ASINs(
+    product_pages_folder, ASINs, current_year, processes, backend
+):
+    product_rows = RowAccumulator(PRODUCT_COLUMNS)
+    failed_ASINs = set()
+    # run_stages can start lucene's JVM on another thread, which isn't safe to fork
+    with ProcessPoolExecutor(processes, mp_context=get_context("spawn")) as executor:
+        # map returns results in the same order as the chunks
+        for chunk_rows, errors in executor.map(
+            parse_product_chunk,
+            repeat(product_pages_folder),
+            array_split(ASINs, processes * CHUNKS_PER_PROCESS),
+            repeat(current_year),
+            repeat(backend),
+        ):
+            product_rows.extend(chunk_rows)
+            for ASIN, error in errors:
+                print("Error: ", ASIN, error)
+                failed_ASINs.add(ASIN)
+
+    return product_rows, failed_ASINs
+
+
+def multiprocess_parse_product_pages(
+    product_pages_folder, current_year, processes=cpu_count(), backend=SOUP_BACKEND
+):
+    # sort so the rows come back in the same order every time
+    product_rows, _ = multiprocess_parse_ASINs(
+        product_pages_folder,
+        sorted(get_page_store(product_pages_folder).ASINs()),
+        current_year,
+        processes,
+        backend,
+    )
+    return product_rows.to_data_frame()
+
+
+# parse each page with both backends, and return the ASINs where they disagree
+def cross_check_backends(product_pages_folder, current_year):
+    mismatched_ASINs = []
+    for ASIN in sorted(get_page_store(product_pages_folder).ASINs()):
+        results = []
+        for backend in HTML_PARSERS.keys():
+            product_rows = RowAccumulator(PRODUCT_COLUMNS)
+            # both backends should fail the same way too
+            try:
+                parse_product_page(
+                    product_rows,
+                    product_pages_folder,
+                    ASIN,
+                    current_year,
+                    backend,
+                )
+                results.append(list(product_rows))
+            except Exception as exception:
+                results.append(repr(exception))
+
+        if results[0] != results[1]:
+            print("Mismatch: ", ASIN)
+            mismatched_ASINs.append(ASIN)
+
+    return mismatched_ASINs
+
+
+# bump this whenever the parsing changes, so cached rows get reparsed
+PARSER_VERSION = 1
+
+
+# pages maps each ASIN to the stamp and hash of its page, and its row
+# the row is None for pages that aren't really products
+def read_parse_cache(parse_cache_file, current_year):
+    if path.isfile(parse_cache_file):
+        with open(parse_cache_file, "rb") as io:
+            parse_cache = pickle.load(io)
+        # start over if the parser or the year has changed
+        if (
+            parse_cache["parser_version"] == PARSER_VERSION
+            and parse_cache["current_year"] == current_year
+        ):
+            return parse_cache
+
+    return {
+        "parser_version": PARSER_VERSION,
+        "current_year": current_year,
+        "pages": {},
+    }
+
+
+def write_parse_cache(parse_cache, parse_cache_file):
+    # write to a temporary file first, so a crash won't corrupt the cache
+    temporary_file = parse_cache_file + ".tmp"
+    with open(temporary_file, "wb") as io:
+        pickle.dump(parse_cache, io, protocol=pickle.HIGHEST_PROTOCOL)
+    replace(temporary_file, parse_cache_file)
+
+
+# only parse new or changed pages, and get the rest from the cache
+def incremental_parse_product_pages(
+    product_pages_folder,
+    current_year,
+    parse_cache_file,
+    processes=cpu_count(),
+    backend=SOUP_BACKEND,
+):
+    parse_cache = read_parse_cache(parse_cache_file, current_year)
+    cached_pages = parse_cache["pages"]
+
+    # sort so the rows come back in the same order every time
+    page_store = get_page_store(product_pages_folder)
+    ASINs = sorted(page_store.ASINs())
+    pages = {}
+    new_pages = {}
+    for ASIN in ASINs:
+        stamp = page_store.get_stamp(ASIN)
+        cached_page = cached_pages.get(ASIN)
+        if not cached_page is None and cached_page["stamp"] == stamp:
+            pages[ASIN] = cached_page
+            continue
+
+        # the page was touched, but the contents might be the same
+        page_hash = page_store.get_hash(ASIN)
+        if not cached_page is None and cached_page["hash"] == page_hash:
+            cached_page["stamp"] = stamp
+            pages[ASIN] = cached_page
+            continue
+
+        new_pages[ASIN] = {"stamp": stamp, "hash": page_hash, "row": None}
+
+    print("Parsing {0:d} new or changed pages".format(len(new_pages)))
+    if new_pages:
+        new_rows, failed_ASINs = multiprocess_parse_ASINs(
+            product_pages_folder,
+            list(new_pages.keys()),
+            current_year,
+            processes,
+            backend,
+        )
+        for row in new_rows:
+            new_pages[row["ASIN"]]["row"] = row
+        for ASIN, new_page in new_pages.items():
+            # don't cache failures, so we try again next time
+            if not ASIN in failed_ASINs:
+                pages[ASIN] = new_page
+
+    # pages that are gone drop out of the cache
+    parse_cache["pages"] = pages
+    write_parse_cache(parse_cache, parse_cache_file)
+
+    product_rows = RowAccumulator(PRODUCT_COLUMNS)
+    for ASIN in ASINs:
+        page = pages.get(ASIN)
+        if not (page is None or page["row"] is None):
+            product_rows.append(page["row"])
+
+    return product_rows.to_data_frame()
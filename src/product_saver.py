@@ -1,170 +1,200 @@
 from concurrent.futures import ThreadPoolExecutor
 import gc
-from numpy import array_split, copy
-from os import cpu_count, path
+from queue import Empty, PriorityQueue
 from selenium.webdriver.common.by import By
 from selenium.common.exceptions import TimeoutException
-from selenium.webdriver.support.expected_conditions import (
-    presence_of_element_located as located,
+from src.browser import (
+    BrowserPool,
+    FAKESPOT_OPT_IN_RULES,
+    FAKESPOT_OPT_IN_STAGE,
+    FAKESPOT_RULES,
+    FAKESPOT_STAGE,
+    READY,
+    SPARE_BROWSERS,
+    wait_for_amazon,
+    wait_for_rules,
+    wait_times,
 )
-from selenium.webdriver.support.wait import WebDriverWait as wait
 from src.utilities import (
     FoiledAgainError,
     GoneError,
-    get_filenames,
-    new_browser,
     only,
-    save_browser,
-    switch_user_agent,
-    wait_for_amazon,
-    WAIT_TIME,
+    WentWrongError,
+)
+from src.page_store import (
+    BROWSER_SOURCE,
+    clean_page_source,
+    create_packed_page_store,
+    get_page_store,
+    PageSources,
+    save_page_source,
+    save_raw_page_source,
+    write_cleaned_page,
 )
-from time import sleep
+from src.pipeline import PagePipeline
+from threading import Lock
+from time import sleep, time
 from urllib3.exceptions import ProtocolError
 
+# how many times to try a product before giving up
+MAX_TRIES = 3
+# seconds to wait before retrying a product, doubled after each try
+BACKOFF_TIME = 30
+# seconds to wait for a product when the queue is empty
+QUEUE_WAIT_TIME = 1
+# report throughput after this many products
+REPORT_EVERY = 100
+
+
 # product_url = product_url_data.loc[:, "product_url"][0]
 def save_product_page(
     thread_id,
     browser,
     ASIN,
     product_pages_folder,
-    first_time = False
+    first_time = False,
+    raw_capture = False,
+    pipeline = None,
+    page_sources = None,
+    progress = None,
 ):
     print("thread {0:d} saving product {1}!".format(thread_id, ASIN))
     browser.get("https://www.amazon.com/dp/" + ASIN)
 
     wait_for_amazon(browser)
     if first_time:
-        try:
-            wait(browser, WAIT_TIME).until(
-                located((By.CSS_SELECTOR, "button#fs-opt-in"))
-            )
+        if (
+            wait_for_rules(browser, FAKESPOT_OPT_IN_STAGE, FAKESPOT_OPT_IN_RULES)
+            == READY
+        ):
             only(browser.find_elements(By.CSS_SELECTOR, "button#fs-opt-in")).click()
-        except TimeoutException as an_error:
-            pass
 
-    try:
-        # wait for fakespot grade
-        wait(browser, WAIT_TIME).until(
-            located((By.CSS_SELECTOR, "div.fakespot-main-grade-box-wrapper"))
+    # wait for fakespot grade
+    # might not be a fakespot grade, but then we usually find out right away
+    wait_for_rules(browser, FAKESPOT_STAGE, FAKESPOT_RULES)
+
+    if raw_capture:
+        # clean later with clean_raw_pages
+        save_raw_page_source(product_pages_folder, ASIN, browser.page_source)
+        add_page_source(page_sources, ASIN)
+    elif not pipeline is None:
+        # clean in another process, so the browser can move on
+        pipeline.write(
+            write_product_page,
+            product_pages_folder,
+            pipeline.submit(
+                clean_page_source, product_pages_folder, ASIN, browser.page_source
+            ),
+            page_sources,
+            progress,
         )
-    except TimeoutException:
-        # might not be a fakespot grade
-        pass
-
-    save_browser(
-        browser,
-        path.join(product_pages_folder, ASIN + ".html"),
-    )
+    else:
+        save_page_source(product_pages_folder, ASIN, browser.page_source)
+        add_page_source(page_sources, ASIN)
     gc.collect()
 
+
+# a browser got this page, so it has its fakespot grade
+def add_page_source(page_sources, ASIN):
+    if not page_sources is None:
+        page_sources.add(ASIN, BROWSER_SOURCE)
+
+
+# on the pipeline's writer thread
+# only count the page as saved once it's written
+def write_product_page(
+    product_pages_folder, cleaned_page_future, page_sources=None, progress=None
+):
+    try:
+        write_cleaned_page(product_pages_folder, cleaned_page_future)
+    except Exception:
+        if not progress is None:
+            progress.add("failed")
+        raise
+    (ASIN, _) = cleaned_page_future.result()
+    add_page_source(page_sources, ASIN)
+    if not progress is None:
+        progress.add("saved")
+
+# keep track of how fast we're going, across all threads
+class Progress:
+    def __init__(self, total):
+        self.lock = Lock()
+        self.start_time = time()
+        self.total = total
+        self.saved = 0
+        self.gone = 0
+        self.failed = 0
+
+    def report(self):
+        elapsed = time() - self.start_time
+        finished = self.saved + self.gone + self.failed
+        print(
+            "{0:d}/{1:d} products done, {2:d} saved, {3:d} gone, {4:d} failed, {5:.1f} saved per minute".format(
+                finished,
+                self.total,
+                self.saved,
+                self.gone,
+                self.failed,
+                self.saved / max(elapsed, 1) * 60,
+            )
+        )
+
+    def add(self, outcome):
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            if (self.saved + self.gone + self.failed) % REPORT_EVERY == 0:
+                self.report()
+
+
+# try again later, unless we've already tried too many times
+def retry_later(ASIN_queue, progress, ASIN, tries, reason):
+    if tries >= MAX_TRIES:
+        print(str(ASIN))
+        print(reason + ", giving up")
+        progress.add("failed")
+    else:
+        print(str(ASIN))
+        print(reason + ", retrying later")
+        ASIN_queue.put((time() + BACKOFF_TIME * 2 ** (tries - 1), tries, ASIN))
+
+
+# each thread has its own browser, and pulls products from the shared queue
+# so threads that hit a lot of timeouts or captchas don't hold up the others
 def save_product_pages(
     thread_id,
-    product_ASINs,
+    ASIN_queue,
+    progress,
     product_pages_folder,
-    user_agents,
-    user_agent_index=0,
+    browser_pool,
+    raw_capture=False,
+    pipeline=None,
+    page_sources=None,
 ):
     print("started thread {0:d}!".format(thread_id))
-    browser = new_browser(user_agents[user_agent_index], fakespot=True)
-
-    completed_product_filenames = get_filenames(product_pages_folder)
+    browser = browser_pool.get()
     first_time = True
 
-    # no previous product, so starts empty
-    # product_url = product_url_data.loc[:, "url"][0]
-    for ASIN in product_ASINs:
-        # don't save a product we already have
-        if ASIN in completed_product_filenames:
-            continue
-
-        try:
-            save_product_page(
-                thread_id,
-                browser,
-                ASIN,
-                product_pages_folder,
-                first_time
-            )
-        except GoneError:
-            # if the product is gone, print some debug information, and just continue
-            print(str(ASIN))
-            print("Page no longer exists, skipping")
-            continue
-        except TimeoutException:
-            # if the product times out, print some debug information, and just continue
-            # come back to get it later
-            print(str(ASIN))
-            print("Timeout, skipping")
-            continue
-        except ProtocolError:
-            print("WiFi dropped, sleeping and retrying")
-            sleep(60)
+    try:
+        while True:
             try:
-                save_product_page(
-                    thread_id,
-                    browser,
-                    ASIN,
-                    product_pages_folder,
-                    first_time
-                )
-            # hande the errors above again, except for the FoiledAgain error
-            # if there's still a captcha this time, just give up
-            except GoneError:
-                print(str(ASIN))
-                print("Page no longer exists, skipping")
+                # the earliest retry time comes first
+                (retry_time, tries, ASIN) = ASIN_queue.get(timeout=QUEUE_WAIT_TIME)
+            except Empty:
+                # stop once no other thread might put a retry back on the queue
+                if ASIN_queue.unfinished_tasks == 0:
+                    break
                 continue
-            except TimeoutException:
-                print(str(ASIN))
-                print("Timeout, skipping")
-                continue
-            except FoiledAgainError:
-                browser, user_agent_index = switch_user_agent(
-                    browser, user_agents, user_agent_index
-                )
-                try:
-                    save_product_page(
-                        thread_id,
-                        browser,
-                        ASIN,
-                        product_pages_folder,
-                        first_time
-                    )
-                # hande the errors above again, except for the FoiledAgain error
-                # if there's still a captcha this time, just give up
-                except GoneError:
-                    print(str(ASIN))
-                    print("Page no longer exists, skipping")
-                    continue
-                except TimeoutException:
-                    print(str(ASIN))
-                    print("Timeout, skipping")
-                    continue
-        except FoiledAgainError:
-            browser, user_agent_index = switch_user_agent(
-                browser, user_agents, user_agent_index
-            )
+
             try:
-                save_product_page(
-                    thread_id,
-                    browser,
-                    ASIN,
-                    product_pages_folder,
-                    first_time
-                )
-            # hande the errors above again, except for the FoiledAgain error
-            # if there's still a captcha this time, just give up
-            except GoneError:
-                print(str(ASIN))
-                print("Page no longer exists, skipping")
-                continue
-            except TimeoutException:
-                print(str(ASIN))
-                print("Timeout, skipping")
-                continue
-            except ProtocolError:
-                print("WiFi dropped, sleeping and retrying")
-                sleep(60)
+                wait_time = retry_time - time()
+                if wait_time > 0:
+                    # nothing is ready yet, so put it back and wait
+                    ASIN_queue.put((retry_time, tries, ASIN))
+                    sleep(min(wait_time, QUEUE_WAIT_TIME))
+                    continue
+
+                tries = tries + 1
                 try:
                     save_product_page(
                         thread_id,
@@ -172,37 +202,131 @@ def save_product_pages(
                         ASIN,
                         product_pages_folder,
                         first_time,
+                        raw_capture,
+                        pipeline,
+                        page_sources,
+                        progress,
                     )
-                # hande the errors above again, except for the FoiledAgain error
-                # if there's still a captcha this time, just give up
+                    # with a pipeline, the writer counts the page once it's written
+                    if raw_capture or pipeline is None:
+                        progress.add("saved")
                 except GoneError:
+                    # if the product is gone, print some debug information, and just continue
                     print(str(ASIN))
                     print("Page no longer exists, skipping")
-                    continue
+                    progress.add("gone")
                 except TimeoutException:
-                    print(str(ASIN))
-                    print("Timeout, skipping")
-                    continue
-        first_time = False
-
-    browser.close()
+                    retry_later(ASIN_queue, progress, ASIN, tries, "Timeout")
+                except ProtocolError:
+                    retry_later(ASIN_queue, progress, ASIN, tries, "WiFi dropped")
+                except WentWrongError:
+                    retry_later(ASIN_queue, progress, ASIN, tries, "Went wrong")
+                except FoiledAgainError:
+                    browser = browser_pool.switch(browser)
+                    if tries >= MAX_TRIES:
+                        retry_later(ASIN_queue, progress, ASIN, tries, "Captcha")
+                    else:
+                        # a new user agent should get through right away
+                        ASIN_queue.put((time(), tries, ASIN))
+                first_time = False
+                # swap out old or crashed browsers
+                browser = browser_pool.recycle(browser)
+            finally:
+                # mark this try done only after any retry is back on the queue
+                # even if this thread dies, so the other threads still know when to stop
+                ASIN_queue.task_done()
+    finally:
+        browser_pool.release(browser)
     print("finished thread {0:d}!".format(thread_id))
 
-    return user_agent_index
 
-def multithread_save_product_pages(threads, user_agents, ASINs, product_pages_folder):
-    with ThreadPoolExecutor() as executor:
-        for result in executor.map(
-            lambda thread_id, sub_product_list, sub_user_agent_list: save_product_pages(
-                thread_id,
-                copy(sub_product_list),
-                product_pages_folder,
-                copy(sub_user_agent_list),
-            ),
-            range(threads),
-            array_split(
-                ASINs, threads
-            ),
-            array_split(user_agents, threads),
-        ):
-            print(result)
+def multithread_save_product_pages(
+    threads,
+    user_agents,
+    ASINs,
+    product_pages_folder,
+    user_agent_index=0,
+    spare_browsers=SPARE_BROWSERS,
+    raw_capture=False,
+    pipeline_processes=None,
+    page_sources_file=None,
+    grade_http_pages=False,
+    cleaned_pages_folder=None,
+):
+    # raw pages always go in a packed store
+    if raw_capture:
+        create_packed_page_store(product_pages_folder)
+
+    # check for completed products once, instead of once per thread
+    completed_product_filenames = set(get_page_store(product_pages_folder).ASINs())
+    # pages we saved before switching to raw capture are already done too
+    if not cleaned_pages_folder is None:
+        completed_product_filenames = completed_product_filenames | set(
+            get_page_store(cleaned_pages_folder).ASINs()
+        )
+
+    page_sources = None
+    if not page_sources_file is None:
+        page_sources = PageSources(page_sources_file)
+        # pages from http_save_product_pages don't have a fakespot grade
+        # but getting it means loading the whole page again in a browser, so only if asked
+        if grade_http_pages:
+            completed_product_filenames = (
+                completed_product_filenames - page_sources.needs_grade()
+            )
+
+    ASIN_queue = PriorityQueue()
+    # no tries yet, so every product is ready now
+    start_time = time()
+    number_of_ASINs = 0
+    for ASIN in ASINs:
+        # don't save a product we already have
+        if not ASIN in completed_product_filenames:
+            ASIN_queue.put((start_time, 0, ASIN))
+            number_of_ASINs = number_of_ASINs + 1
+
+    pipeline = None
+    browser_pool = None
+    # close everything even if a browser thread fails
+    # otherwise the pipeline's writer thread keeps the process alive, and firefox is left running
+    try:
+        # clean pages in a pool of processes, instead of on the browser threads
+        if not pipeline_processes is None:
+            pipeline = PagePipeline(pipeline_processes)
+
+        progress = Progress(number_of_ASINs)
+        browser_pool = BrowserPool(
+            user_agents,
+            user_agent_index,
+            fakespot=True,
+            spare_browsers=spare_browsers,
+        )
+        with ThreadPoolExecutor(threads) as executor:
+            # list to raise any errors from the threads
+            list(
+                executor.map(
+                    lambda thread_id: save_product_pages(
+                        thread_id,
+                        ASIN_queue,
+                        progress,
+                        product_pages_folder,
+                        browser_pool,
+                        raw_capture,
+                        pipeline,
+                        page_sources,
+                    ),
+                    range(threads),
+                )
+            )
+    finally:
+        if not browser_pool is None:
+            browser_pool.close()
+        if not pipeline is None:
+            pipeline.close()
+        if not page_sources is None:
+            page_sources.close()
+
+    progress.report()
+    wait_times.report()
+
+    return browser_pool.user_agent_index
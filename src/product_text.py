@@ -0,0 +1,55 @@
+from bs4 import BeautifulSoup
+from src.field_extractor import FieldExtractor, FieldSpec
+from src.page_store import get_page_store
+from src.utilities import parse_html
+
+# this doesn't import lucene, so processes that extract text don't start their own JVM
+
+# index the whole page, markup and all, in one product_text field
+MARKUP_MODE = "markup"
+# index only the text of the parts of the page that describe the product, in separate fields
+FIELDS_MODE = "fields"
+
+
+# text of all the widgets, with spaces between the bits of text
+def get_joined_text(widgets):
+    return " ".join(widget.get_text(" ", strip=True) for widget in widgets)
+
+
+PRODUCT_TEXT_EXTRACTOR = FieldExtractor(
+    [
+        FieldSpec("title", "span#productTitle", transform=get_joined_text),
+        FieldSpec("bullets", "div#feature-bullets li", transform=get_joined_text),
+        FieldSpec(
+            "description",
+            "div#productDescription, div#bookDescription_feature_div",
+            transform=get_joined_text,
+        ),
+        FieldSpec(
+            "details",
+            "div#prodDetails, div#detailBulletsWrapper_feature_div",
+            transform=get_joined_text,
+        ),
+    ]
+)
+
+PRODUCT_TEXT_FIELDS = list(PRODUCT_TEXT_EXTRACTOR.field_specs.keys())
+
+# how much a match in each field counts
+FIELD_BOOSTS = {"title": 3.0, "bullets": 2.0, "description": 1.0, "details": 0.5}
+
+
+# field: text, for each field we index
+def extract_product_text(page_source, mode):
+    if mode == MARKUP_MODE:
+        return {"product_text": BeautifulSoup(page_source, "lxml").prettify()}
+    fields = PRODUCT_TEXT_EXTRACTOR.extract(parse_html(page_source))
+    return {field: fields[field] for field in PRODUCT_TEXT_FIELDS}
+
+
+# ASINs = get_page_store(product_pages_folder).ASINs()[0:10]
+def extract_product_chunk(product_pages_folder, ASINs, mode):
+    page_store = get_page_store(product_pages_folder)
+    return [
+        (ASIN, extract_product_text(page_store.read(ASIN), mode)) for ASIN in ASINs
+    ]
@@ -1,64 +1,354 @@
+# the lucene relevance backend, see relevance_data
 # build pylucene first
 # I used oracle JDK 17
 # importing lucene enables a bunch of other imports
 import lucene
 
-from bs4 import BeautifulSoup
+from array import array
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from java.lang import Float
 from java.nio.file import Paths
-from os import path
+from java.util import HashMap
 from org.apache.lucene.analysis.standard import StandardAnalyzer
-from org.apache.lucene.document import Document, Field, StringField, TextField
-from org.apache.lucene.index import DirectoryReader, IndexWriter, IndexWriterConfig
-from org.apache.lucene.queryparser.classic import QueryParser
-from org.apache.lucene.search import IndexSearcher
+from org.apache.lucene.document import (
+    BinaryDocValuesField,
+    Document,
+    Field,
+    SortedDocValuesField,
+    StringField,
+    TextField,
+)
+from org.apache.lucene.index import (
+    DirectoryReader,
+    IndexWriter,
+    IndexWriterConfig,
+    MultiBits,
+    Term,
+)
+from org.apache.lucene.queryparser.classic import MultiFieldQueryParser, QueryParser
+from org.apache.lucene.search import DocIdSetIterator, IndexSearcher
 from org.apache.lucene.store import NIOFSDirectory
-from pandas import concat, DataFrame
-from src.utilities import get_filenames
+from org.apache.lucene.util import BytesRef
+from multiprocessing import get_context
+from os import cpu_count
+from src.page_store import get_page_store
+from src.product_text import (
+    extract_product_chunk,
+    FIELD_BOOSTS,
+    MARKUP_MODE,
+    PRODUCT_TEXT_FIELDS,
+)
+from src.relevance_data import SEARCH_THREADS
+from threading import BoundedSemaphore
+from time import perf_counter
 
 
-def index_product_pages(lucene_folder, product_pages_folder):
-    writer = IndexWriter(
-        NIOFSDirectory(Paths.get(lucene_folder)), IndexWriterConfig(StandardAnalyzer())
+# how much memory lucene can buffer documents in before flushing them to disk
+RAM_BUFFER_MB = 256.0
+
+# commit after this many changed documents, so a crash doesn't lose everything
+COMMIT_EVERY = 10000
+
+# how many threads add documents to the shared index writer
+INDEX_THREADS = 4
+
+# how many pages each process extracts text from at a time
+INDEX_CHUNK_SIZE = 100
+
+# how many chunks can be extracted but not yet indexed, per process
+CHUNKS_PER_PROCESS = 2
+
+
+# the value of a doc values field for every document id, in one pass
+# None for documents without the field
+def read_doc_values(reader, field):
+    values_by_doc = [None] * reader.maxDoc()
+    for leaf in reader.leaves():
+        doc_base = leaf.docBase
+        values = leaf.reader().getSortedDocValues(field)
+        if values is None:
+            continue
+        doc = values.nextDoc()
+        while doc != DocIdSetIterator.NO_MORE_DOCS:
+            values_by_doc[doc_base + doc] = values.lookupOrd(
+                values.ordValue()
+            ).utf8ToString()
+            doc = values.nextDoc()
+    return values_by_doc
+
+
+# the same, for a binary doc values field
+def read_binary_doc_values(reader, field):
+    values_by_doc = [None] * reader.maxDoc()
+    for leaf in reader.leaves():
+        doc_base = leaf.docBase
+        values = leaf.reader().getBinaryDocValues(field)
+        if values is None:
+            continue
+        doc = values.nextDoc()
+        while doc != DocIdSetIterator.NO_MORE_DOCS:
+            values_by_doc[doc_base + doc] = values.binaryValue().utf8ToString()
+            doc = values.nextDoc()
+    return values_by_doc
+
+
+# documents indexed before we added doc values fall back to the stored field
+def get_ASINs_by_doc(searcher):
+    return read_doc_values(searcher.getIndexReader(), "ASIN")
+
+
+# changing how we index a page should reindex it, just like changing the page
+def get_index_stamp(content_hash, mode, store_text):
+    return "\t".join([content_hash, mode, str(store_text)])
+
+
+# ASIN: (index stamp, page stamp), for the documents already in the index
+# the page stamp is None for documents indexed before we kept it
+def get_indexed_stamps(directory):
+    if not DirectoryReader.indexExists(directory):
+        return {}
+    reader = DirectoryReader.open(directory)
+    # None if nothing has been deleted
+    live_docs = MultiBits.getLiveDocs(reader)
+    indexed_stamps = {}
+    for doc, (ASIN, index_stamp, page_stamp) in enumerate(
+        zip(
+            read_doc_values(reader, "ASIN"),
+            read_doc_values(reader, "index_stamp"),
+            read_binary_doc_values(reader, "page_stamp"),
+        )
+    ):
+        if not ASIN is None and (live_docs is None or live_docs.get(doc)):
+            indexed_stamps[ASIN] = (index_stamp, page_stamp)
+    reader.close()
+    return indexed_stamps
+
+
+# only store the text if we need to read it back out of the index
+def get_product_document(ASIN, index_stamp, page_stamp, product_text, store_text):
+    doc = Document()
+    doc.add(Field("ASIN", ASIN, StringField.TYPE_STORED))
+    # a column of ASINs, so we don't have to load whole documents to look them up
+    doc.add(SortedDocValuesField("ASIN", BytesRef(ASIN)))
+    # so we can tell whether the page changed since we indexed it
+    doc.add(SortedDocValuesField("index_stamp", BytesRef(index_stamp)))
+    # binary, so we can update it without reindexing the page
+    doc.add(BinaryDocValuesField("page_stamp", BytesRef(page_stamp)))
+    if store_text:
+        field_type = TextField.TYPE_STORED
+    else:
+        field_type = TextField.TYPE_NOT_STORED
+    for field, text in product_text.items():
+        doc.add(Field(field, text, field_type))
+    return doc
+
+
+# each thread needs to be attached to the JVM before it can call lucene
+def attach_thread():
+    lucene.getVMEnv().attachCurrentThread()
+
+
+# the index writer is thread-safe, so many threads can add to it at once
+# index_stamps maps each ASIN to (index stamp, page stamp)
+def index_chunk(writer, extracted_chunk, index_stamps, store_text):
+    for ASIN, product_text in extracted_chunk:
+        (index_stamp, page_stamp) = index_stamps[ASIN]
+        # replaces any documents with the same ASIN, including duplicates from older runs
+        writer.updateDocument(
+            Term("ASIN", ASIN),
+            get_product_document(
+                ASIN, index_stamp, page_stamp, product_text, store_text
+            ),
+        )
+    return len(extracted_chunk)
+
+
+def report_indexing(indexing, start_time):
+    documents = sum(future.result() for future in indexing if future.done())
+    print(
+        "{0:d} documents indexed, {1:.1f} documents/second".format(
+            documents, documents / (perf_counter() - start_time)
+        )
     )
-    for ASIN in get_filenames(product_pages_folder):
-        print(ASIN)
-        doc = Document()
-        doc.add(Field("ASIN", ASIN, StringField.TYPE_STORED))
-        with open(
-            path.join(product_pages_folder, ASIN + ".html"), "r", encoding="UTF-8"
-        ) as io:
-            doc.add(
-                Field(
-                    "product_text",
-                    BeautifulSoup(io, "lxml", from_encoding="UTF-8").prettify(),
-                    TextField.TYPE_STORED,
-                )
+
+
+# only index pages that are new or changed since last time
+# and delete ASINs that aren't in the page store any more
+# processes extract the text, and threads feed it to one shared writer
+def index_product_pages(
+    lucene_folder,
+    product_pages_folder,
+    ram_buffer_mb=RAM_BUFFER_MB,
+    commit_every=COMMIT_EVERY,
+    mode=MARKUP_MODE,
+    store_text=False,
+    processes=cpu_count(),
+    threads=INDEX_THREADS,
+):
+    directory = NIOFSDirectory(Paths.get(lucene_folder))
+    indexed_stamps = get_indexed_stamps(directory)
+    config = IndexWriterConfig(StandardAnalyzer())
+    if indexed_stamps:
+        config.setOpenMode(IndexWriterConfig.OpenMode.CREATE_OR_APPEND)
+    else:
+        # an index from before we kept stamps has no ASIN doc values, so we could never find its documents to delete
+        # and lucene won't add doc values to a field that already exists without them, so start over
+        config.setOpenMode(IndexWriterConfig.OpenMode.CREATE)
+    config.setRAMBufferSizeMB(ram_buffer_mb)
+    writer = IndexWriter(directory, config)
+
+    # always close the writer, so it lets go of write.lock
+    try:
+        page_store = get_page_store(product_pages_folder)
+        ASINs = page_store.ASINs()
+        index_stamps = {}
+        for ASIN in ASINs:
+            (indexed_stamp, indexed_page_stamp) = indexed_stamps.get(ASIN, (None, None))
+            # check the cheap stamp first, so we only read pages that might have changed
+            page_stamp = get_index_stamp(
+                str(page_store.get_stamp(ASIN)), mode, store_text
             )
-        writer.addDocument(doc)
-    writer.commit()
-    writer.close()
+            if indexed_page_stamp == page_stamp:
+                continue
+            index_stamp = get_index_stamp(page_store.get_hash(ASIN), mode, store_text)
+            if indexed_stamp == index_stamp and not indexed_page_stamp is None:
+                # the same page, just written again, so remember the new stamp
+                writer.updateBinaryDocValue(
+                    Term("ASIN", ASIN), "page_stamp", BytesRef(page_stamp)
+                )
+            else:
+                index_stamps[ASIN] = (index_stamp, page_stamp)
+        changed_ASINs = list(index_stamps.keys())
+        print("Indexing {0:d} new or changed pages".format(len(changed_ASINs)))
+
+        start_time = perf_counter()
+        submitted = 0
+        last_commit = 0
+        extracting = set()
+        indexing = []
+        # extracted chunks hold all their text, so cap how many wait for the index threads
+        index_slots = BoundedSemaphore(processes * CHUNKS_PER_PROCESS)
+        # forking a process with a running JVM isn't safe, so spawn fresh ones
+        with ProcessPoolExecutor(
+            processes, mp_context=get_context("spawn")
+        ) as process_executor, ThreadPoolExecutor(
+            threads, initializer=attach_thread
+        ) as thread_executor:
+
+            def index_extracted(done):
+                for future in done:
+                    # wait if too many chunks are already waiting to be indexed
+                    index_slots.acquire()
+                    index_future = thread_executor.submit(
+                        index_chunk, writer, future.result(), index_stamps, store_text
+                    )
+                    index_future.add_done_callback(lambda _: index_slots.release())
+                    indexing.append(index_future)
+
+            for index in range(0, len(changed_ASINs), INDEX_CHUNK_SIZE):
+                # don't extract much faster than we can index
+                if len(extracting) >= processes * CHUNKS_PER_PROCESS:
+                    (done, extracting) = wait(extracting, return_when=FIRST_COMPLETED)
+                    index_extracted(done)
+                ASINs_chunk = changed_ASINs[index : index + INDEX_CHUNK_SIZE]
+                extracting.add(
+                    process_executor.submit(
+                        extract_product_chunk, product_pages_folder, ASINs_chunk, mode
+                    )
+                )
+                submitted = submitted + len(ASINs_chunk)
+                if submitted - last_commit >= commit_every:
+                    # commits whatever the threads have added so far
+                    writer.commit()
+                    last_commit = submitted
+                    report_indexing(indexing, start_time)
+
+            index_extracted(extracting)
+            # raise any errors from the threads
+            for future in indexing:
+                future.result()
 
+        gone_ASINs = set(indexed_stamps.keys()).difference(ASINs)
+        for ASIN in gone_ASINs:
+            writer.deleteDocuments(Term("ASIN", ASIN))
 
-def get_relevance_data(lucene_folder, queries, number_of_matches):
+        writer.commit()
+    finally:
+        writer.close()
+    report_indexing(indexing, start_time)
+    print("Deleted {0:d} gone pages".format(len(gone_ASINs)))
+
+
+# returns the ASINs and scores for one query, best first
+# keep the top number_of_matches, and only those with at least minimum_score
+def search_query(searcher, ASINs_by_doc, parsed_query, number_of_matches, minimum_score):
+    ASINs = []
+    scores = array("d")
+    for score_data in searcher.search(parsed_query, number_of_matches).scoreDocs:
+        score = score_data.score
+        # hits are sorted by score, so the rest are lower too
+        if not minimum_score is None and score < minimum_score:
+            break
+        ASIN = ASINs_by_doc[score_data.doc]
+        if ASIN is None:
+            ASIN = searcher.doc(score_data.doc)["ASIN"]
+        ASINs.append(ASIN)
+        scores.append(score)
+    return ASINs, scores
+
+
+# search the fields we indexed with, all the query words have to match somewhere
+def get_query_parser(mode, field_boosts):
+    if mode == MARKUP_MODE:
+        parser = QueryParser("product_text", StandardAnalyzer())
+    else:
+        boosts = HashMap()
+        for field, boost in field_boosts.items():
+            boosts.put(field, Float(boost))
+        parser = MultiFieldQueryParser(PRODUCT_TEXT_FIELDS, StandardAnalyzer(), boosts)
+    parser.setDefaultOperator(QueryParser.Operator.AND)
+    return parser
+
+
+# yields query, ASINs, scores for each query, in order
+# lucene searches are thread-safe, so the threads share one searcher
+def search_queries(
+    lucene_folder,
+    queries,
+    number_of_matches,
+    minimum_score=None,
+    threads=SEARCH_THREADS,
+    mode=MARKUP_MODE,
+    field_boosts=FIELD_BOOSTS,
+):
     searcher = IndexSearcher(
         DirectoryReader.open(NIOFSDirectory(Paths.get(lucene_folder)))
     )
-    parser = QueryParser("product_text", StandardAnalyzer())
-    parser.setDefaultOperator(QueryParser.Operator.AND)
+    ASINs_by_doc = get_ASINs_by_doc(searcher)
+    # the parser isn't thread-safe, so parse everything up front
+    parser = get_query_parser(mode, field_boosts)
+    parsed_queries = [parser.parse(query) for query in queries]
 
-    results = []
-    for query in queries:
-        print(query)
-        for score_data in searcher.search(parser.parse(query), number_of_matches).scoreDocs:
-            results.append(
-                DataFrame(
-                    {
-                        "query": [query],
-                        "ASIN": [searcher.doc(score_data.doc)["ASIN"]],
-                        "score": [score_data.score],
-                    }
-                )
-            )
+    with ThreadPoolExecutor(threads, initializer=attach_thread) as executor:
+        for query, (ASINs, scores) in zip(
+            queries,
+            executor.map(
+                lambda parsed_query: search_query(
+                    searcher,
+                    ASINs_by_doc,
+                    parsed_query,
+                    number_of_matches,
+                    minimum_score,
+                ),
+                parsed_queries,
+            ),
+        ):
+            print(query)
+            yield query, ASINs, scores
 
-    del searcher
-    return concat(results, ignore_index=True)
+    searcher.getIndexReader().close()
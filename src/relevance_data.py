@@ -0,0 +1,142 @@
+from array import array
+from importlib import import_module
+from os import cpu_count
+from pandas import DataFrame
+from src.product_text import FIELD_BOOSTS, MARKUP_MODE
+from src.schemas import get_columns, RELEVANCE_SCHEMA
+from src.table_io import TableWriter
+
+# how many queries to search at once
+SEARCH_THREADS = cpu_count()
+
+RELEVANCE_COLUMNS = get_columns(RELEVANCE_SCHEMA)
+
+# pylucene, which needs a JDK and lucene.initVM() first
+LUCENE_BACKEND = "lucene"
+# plain python and numpy
+BM25_BACKEND = "bm25"
+
+# each backend is a module with index_product_pages and search_queries
+# search_queries yields query, ASINs, scores for each query, in order
+# only import a backend when we use it, so the BM25 backend doesn't need a JVM
+RELEVANCE_BACKENDS = {LUCENE_BACKEND: "src.relevance", BM25_BACKEND: "src.bm25"}
+
+
+# error if we ask a backend for something only another backend can do
+class UnsupportedOptionError(Exception):
+    pass
+
+
+def get_relevance_backend(backend):
+    return import_module(RELEVANCE_BACKENDS[backend])
+
+
+# store_text keeps the text in the index, so we can read it back out, lucene only
+def index_product_pages(
+    index_folder,
+    product_pages_folder,
+    mode=MARKUP_MODE,
+    processes=cpu_count(),
+    backend=LUCENE_BACKEND,
+    store_text=False,
+):
+    options = {"mode": mode, "processes": processes}
+    # bm25 never keeps the text
+    if backend == LUCENE_BACKEND:
+        options["store_text"] = store_text
+    elif store_text:
+        raise UnsupportedOptionError("only lucene can store the text")
+    get_relevance_backend(backend).index_product_pages(
+        index_folder, product_pages_folder, **options
+    )
+
+
+def search_queries(
+    index_folder,
+    queries,
+    number_of_matches,
+    minimum_score,
+    threads,
+    mode,
+    field_boosts,
+    backend,
+):
+    return get_relevance_backend(backend).search_queries(
+        index_folder,
+        queries,
+        number_of_matches,
+        minimum_score,
+        threads,
+        mode,
+        field_boosts,
+    )
+
+
+# number_of_matches = product_data.shape[0]
+def get_relevance_data(
+    index_folder,
+    queries,
+    number_of_matches,
+    minimum_score=None,
+    threads=SEARCH_THREADS,
+    mode=MARKUP_MODE,
+    field_boosts=FIELD_BOOSTS,
+    backend=LUCENE_BACKEND,
+):
+    query_column = []
+    ASIN_column = []
+    score_column = array("d")
+    for query, ASINs, scores in search_queries(
+        index_folder,
+        queries,
+        number_of_matches,
+        minimum_score,
+        threads,
+        mode,
+        field_boosts,
+        backend,
+    ):
+        query_column.extend([query] * len(ASINs))
+        ASIN_column.extend(ASINs)
+        score_column.extend(scores)
+
+    return DataFrame(
+        {"query": query_column, "ASIN": ASIN_column, "score": score_column},
+        columns=RELEVANCE_COLUMNS,
+    )
+
+
+# like get_relevance_data, but append each query's results to the file as we go
+# so we never hold all the results at once
+# relevance_file can be .csv or .parquet
+def save_relevance_data(
+    index_folder,
+    queries,
+    relevance_file,
+    number_of_matches,
+    minimum_score=None,
+    threads=SEARCH_THREADS,
+    mode=MARKUP_MODE,
+    field_boosts=FIELD_BOOSTS,
+    backend=LUCENE_BACKEND,
+):
+    table_writer = TableWriter(relevance_file, RELEVANCE_SCHEMA)
+    # so there's a header even with no results
+    table_writer.write(DataFrame(columns=RELEVANCE_COLUMNS))
+    for query, ASINs, scores in search_queries(
+        index_folder,
+        queries,
+        number_of_matches,
+        minimum_score,
+        threads,
+        mode,
+        field_boosts,
+        backend,
+    ):
+        table_writer.write(
+            DataFrame(
+                {"query": [query] * len(ASINs), "ASIN": ASINs, "score": scores},
+                columns=RELEVANCE_COLUMNS,
+            )
+        )
+    table_writer.close()
@@ -1,91 +1,535 @@
-import lucene
-from os import chdir, path
-from pandas import read_csv
-
-chdir("/home/brandon/amazon_scraper")
-
-from src.utilities import maybe_create
-from src.search_saver import save_search_pages
-from src.product_saver import multithread_save_product_pages
-from src.product_parser import parse_product_pages
-from src.relevance import index_product_pages, get_relevance_data
-from src.utilities import combine_folder_csvs
+# run one stage at a time from the project folder, e.g.
+# python -m src.run parse --processes 8
+# python -m src.run --help for all the stages and options
+# each stage imports what it needs when it runs
+# so parsing doesn't start selenium, and only lucene stages start a JVM
+from argparse import ArgumentParser, ArgumentTypeError
+from functools import partial
+from os import cpu_count, mkdir, path
+from src.stage_runner import run_stages, Stage
+import sys
 
 CURRENT_YEAR = 2023
 THREADS = 3
+BROWSERS = 1
+PROCESSES = cpu_count()
+
+INPUTS_FOLDER = "inputs"
+RESULTS_FOLDER = "results"
+
+# tables are saved in this format, unless we pass --table-format
+# csv for stata, parquet is much smaller and faster to load, and keeps the types
+TABLE_FORMAT = "csv"
+
+SEARCH_DATA_TABLE = "search_data"
+
+# how many csvs to read at once when combining them
+READ_THREADS = 8
+
+# how many stages can run at once
+STAGE_THREADS = 2
+
+
+# like utilities.maybe_create, without importing everything utilities does
+def maybe_create(folder):
+    if not path.isdir(folder):
+        mkdir(folder)
+    return folder
+
+
+def get_input_file(arguments, filename):
+    return path.join(arguments.inputs_folder, filename)
+
+
+def get_result_path(arguments, filename):
+    return path.join(maybe_create(arguments.results_folder), filename)
+
+
+# only read the column we need
+# e.g. results/product_data.parquet
+def get_table_file(arguments, table):
+    return get_result_path(arguments, table + "." + arguments.table_format)
+
+
+# with the schema, so a query like 1984 stays a string
+def read_column(file, column, schema):
+    from src.table_io import read_table
+
+    return read_table(file, [column], schema).loc[:, column]
+
+
+def get_index_folder(arguments):
+    return maybe_create(get_result_path(arguments, arguments.backend))
+
+
+# only lucene needs a JVM
+def maybe_start_lucene(backend):
+    from src.relevance_data import LUCENE_BACKEND
+
+    if backend == LUCENE_BACKEND:
+        import lucene
+
+        environment = lucene.getVMEnv()
+        if environment is None:
+            lucene.initVM(vmargs=["-Djava.awt.headless=true"])
+        else:
+            # another stage already started it, on another thread
+            environment.attachCurrentThread()
+
+
+def run_search(arguments):
+    from src.schemas import QUERIES_SCHEMA, USER_AGENTS_SCHEMA
+    from src.search_saver import save_search_pages
+
+    user_agent_index = save_search_pages(
+        read_column(
+            get_input_file(arguments, arguments.queries_file), "query", QUERIES_SCHEMA
+        ),
+        maybe_create(get_result_path(arguments, arguments.output_folder)),
+        # e.g. results/search_results_journal.jsonl
+        get_result_path(arguments, arguments.output_folder + "_journal.jsonl"),
+        read_column(
+            get_input_file(arguments, "user_agents.csv"),
+            "user_agent",
+            USER_AGENTS_SCHEMA,
+        ),
+        user_agent_index=arguments.user_agent_index,
+        require_complete=arguments.require_complete,
+        browsers=arguments.browsers,
+        navigation=arguments.navigation,
+        pipeline_processes=arguments.pipeline_processes,
+    )
+    # pass this as --user-agent-index next time
+    print("Next user agent index: {0:d}".format(user_agent_index))
+
+
+def run_combine(arguments):
+    from src.table_io import save_folder_csvs
+
+    from src.schemas import SEARCH_SCHEMA
+
+    save_folder_csvs(
+        get_result_path(arguments, arguments.input_folder),
+        get_table_file(arguments, arguments.search_data_table),
+        SEARCH_SCHEMA,
+        threads=arguments.read_threads,
+    )
+
+
+def run_ASINs(arguments):
+    from src.schemas import PRODUCT_ASINS_SCHEMA
+    from src.table_io import read_table, write_table
+
+    write_table(
+        read_table(
+            get_table_file(arguments, arguments.search_data_table), ["ASIN"]
+        ).drop_duplicates(),
+        get_table_file(arguments, "product_ASINs_data"),
+        PRODUCT_ASINS_SCHEMA,
+    )
+
+
+def run_products(arguments):
+    from src.product_saver import multithread_save_product_pages
+    from src.schemas import PRODUCT_ASINS_SCHEMA, USER_AGENTS_SCHEMA
+
+    user_agents = read_column(
+        get_input_file(arguments, "user_agents.csv"), "user_agent", USER_AGENTS_SCHEMA
+    )
+    ASINs = read_column(
+        get_table_file(arguments, "product_ASINs_data"), "ASIN", PRODUCT_ASINS_SCHEMA
+    ).sample(frac=1)
+    product_pages_folder = maybe_create(get_result_path(arguments, "product_pages"))
+    # which pages came over http, so have no fakespot grade
+    page_sources_file = get_result_path(arguments, "product_page_sources.tsv")
+    if arguments.http_first:
+        from src.http_fetcher import http_save_product_pages
+
+        http_save_product_pages(
+            user_agents,
+            ASINs,
+            product_pages_folder,
+            page_sources_file,
+            user_agent_index=arguments.user_agent_index,
+        )
+
+    browser_pages_folder = product_pages_folder
+    cleaned_pages_folder = None
+    if arguments.raw_capture:
+        browser_pages_folder = get_result_path(arguments, "raw_product_pages")
+        cleaned_pages_folder = product_pages_folder
+
+    user_agent_index = multithread_save_product_pages(
+        arguments.threads,
+        user_agents,
+        ASINs,
+        browser_pages_folder,
+        user_agent_index=arguments.user_agent_index,
+        raw_capture=arguments.raw_capture,
+        pipeline_processes=arguments.pipeline_processes,
+        page_sources_file=page_sources_file,
+        grade_http_pages=arguments.grade_http_pages,
+        cleaned_pages_folder=cleaned_pages_folder,
+    )
+    print("Next user agent index: {0:d}".format(user_agent_index))
+
+    if arguments.raw_capture:
+        from src.page_store import clean_raw_pages
+
+        # clean everything we captured at once, now the browsers are done
+        clean_raw_pages(browser_pages_folder, product_pages_folder)
+
+
+# clean raw pages again, e.g. with --reclean after changing the junk selectors
+def run_clean(arguments):
+    from src.page_store import clean_raw_pages
+
+    clean_raw_pages(
+        get_result_path(arguments, "raw_product_pages"),
+        maybe_create(get_result_path(arguments, "product_pages")),
+        arguments.processes,
+        reclean=arguments.reclean,
+    )
+
+
+# move an old folder of html files into a packed store
+# the html files are kept in loose_product_pages, in case we need them
+def run_pack(arguments):
+    from os import rename
+    from src.page_store import INDEX_FILE, pack_page_folder
+
+    product_pages_folder = get_result_path(arguments, "product_pages")
+    packed_pages_folder = get_result_path(arguments, "packed_product_pages")
+    loose_pages_folder = get_result_path(arguments, "loose_product_pages")
+    if path.isfile(path.join(product_pages_folder, INDEX_FILE)):
+        print("product_pages is already packed")
+        return
+    if path.exists(loose_pages_folder):
+        print("loose_product_pages already exists, move it out of the way first")
+        return
+    # picks up where it left off if we stopped in the middle
+    pack_page_folder(product_pages_folder, packed_pages_folder)
+    rename(product_pages_folder, loose_pages_folder)
+    rename(packed_pages_folder, product_pages_folder)
+
+
+def run_parse(arguments):
+    from src.product_parser import (
+        cross_check_backends,
+        incremental_parse_product_pages,
+    )
+    from src.schemas import PRODUCT_PARTITION_COLUMNS, PRODUCT_SCHEMA
+    from src.table_io import write_table
+
+    if arguments.cross_check:
+        mismatched_ASINs = cross_check_backends(
+            get_result_path(arguments, "product_pages"), arguments.current_year
+        )
+        print("{0:d} pages parsed differently".format(len(mismatched_ASINs)))
+        return
+
+    write_table(
+        incremental_parse_product_pages(
+            get_result_path(arguments, "product_pages"),
+            arguments.current_year,
+            get_result_path(arguments, "parse_cache.pickle"),
+            processes=arguments.processes,
+            backend=arguments.html_backend,
+        ),
+        get_table_file(arguments, "product_data"),
+        PRODUCT_SCHEMA,
+        PRODUCT_PARTITION_COLUMNS,
+    )
+
+
+def run_index(arguments):
+    maybe_start_lucene(arguments.backend)
+    from src.relevance_data import index_product_pages
+
+    index_product_pages(
+        get_index_folder(arguments),
+        get_result_path(arguments, "product_pages"),
+        mode=arguments.mode,
+        processes=arguments.processes,
+        backend=arguments.backend,
+        store_text=arguments.store_text,
+    )
+
+
+def run_relevance(arguments):
+    maybe_start_lucene(arguments.backend)
+    from src.relevance_data import save_relevance_data
+    from src.schemas import PRODUCT_ASINS_SCHEMA, QUERIES_SCHEMA
+
+    number_of_matches = arguments.number_of_matches
+    if number_of_matches is None:
+        # every product could match
+        number_of_matches = len(
+            read_column(
+                get_table_file(arguments, "product_ASINs_data"),
+                "ASIN",
+                PRODUCT_ASINS_SCHEMA,
+            )
+        )
+
+    save_relevance_data(
+        get_index_folder(arguments),
+        read_column(get_input_file(arguments, "queries.csv"), "query", QUERIES_SCHEMA),
+        get_table_file(arguments, "relevance_data"),
+        number_of_matches,
+        minimum_score=arguments.minimum_score,
+        mode=arguments.mode,
+        backend=arguments.backend,
+    )
+
+
+# the inputs and outputs of each stage, in the order we'd run them by hand
+def get_stages(arguments):
+    queries_file = get_input_file(arguments, arguments.queries_file)
+    user_agents_file = get_input_file(arguments, "user_agents.csv")
+    search_results_folder = get_result_path(arguments, arguments.output_folder)
+    search_data_file = get_table_file(arguments, arguments.search_data_table)
+    product_ASINs_file = get_table_file(arguments, "product_ASINs_data")
+    product_pages_folder = get_result_path(arguments, "product_pages")
+    index_folder = get_result_path(arguments, arguments.backend)
+    return [
+        Stage(
+            "search",
+            partial(run_search, arguments),
+            [queries_file, user_agents_file],
+            [search_results_folder],
+        ),
+        Stage(
+            "combine",
+            partial(run_combine, arguments),
+            [search_results_folder],
+            [search_data_file],
+        ),
+        Stage(
+            "ASINs",
+            partial(run_ASINs, arguments),
+            [search_data_file],
+            [product_ASINs_file],
+        ),
+        Stage(
+            "products",
+            partial(run_products, arguments),
+            [product_ASINs_file, user_agents_file],
+            [product_pages_folder],
+        ),
+        Stage(
+            "parse",
+            partial(run_parse, arguments),
+            [product_pages_folder],
+            [
+                get_table_file(arguments, "product_data"),
+                get_result_path(arguments, "parse_cache.pickle"),
+            ],
+        ),
+        Stage(
+            "index",
+            partial(run_index, arguments),
+            [product_pages_folder],
+            [index_folder],
+        ),
+        Stage(
+            "relevance",
+            partial(run_relevance, arguments),
+            [index_folder, get_input_file(arguments, "queries.csv"), product_ASINs_file],
+            [get_table_file(arguments, "relevance_data")],
+        ),
+    ]
+
+
+STAGE_NAMES = ["search", "combine", "ASINs", "products", "parse", "index", "relevance"]
+
+
+def run_all(arguments):
+    # combine reads the search results we just saved
+    arguments.input_folder = arguments.output_folder
+    run_stages(
+        [
+            stage
+            for stage in get_stages(arguments)
+            if not stage.name in arguments.skip
+        ],
+        get_result_path(arguments, "stage_state.pickle"),
+        arguments.stage_threads,
+        force=arguments.force,
+    )
+
+
+def add_relevance_options(parser):
+    # the same as relevance_data and product_text, which are too heavy to import here
+    parser.add_argument("--backend", choices=["lucene", "bm25"], default="lucene")
+    # markup, like the library, so existing indices and relevance data don't change
+    parser.add_argument(
+        "--mode",
+        choices=["markup", "fields"],
+        default="markup",
+        help="index the page markup, or the title, bullets, description and details as separate fields",
+    )
+
+
+def positive_integer(text):
+    number = int(text)
+    if number < 1:
+        raise ArgumentTypeError("must be at least 1")
+    return number
+
+
+def add_search_options(parser):
+    parser.add_argument("--queries-file", default="queries.csv")
+    parser.add_argument("--output-folder", default="search_results")
+    parser.add_argument("--user-agent-index", type=int, default=0)
+    # how many browsers search at once, each with its own slice of the user agents
+    parser.add_argument("--browsers", type=positive_integer, default=BROWSERS)
+    # the same as search_saver, which is too heavy to import here
+    # url loads search pages directly, and loads the next page while parsing this one
+    parser.add_argument("--navigation", choices=["click", "url"], default="click")
+
+
+# clean and parse pages in this many processes, so the browsers don't wait on it
+def add_pipeline_options(parser):
+    parser.add_argument("--pipeline-processes", type=int, default=None)
+
+
+def add_product_options(parser):
+    # fetch pages over plain http first, and only use browsers for the pages http couldn't get
+    parser.add_argument(
+        "--http-first",
+        action="store_true",
+        help="fetch product pages over plain http before starting browsers; these pages have no fakespot grade",
+    )
+    # each grade costs a full browser visit, so this loses most of what --http-first saves
+    parser.add_argument(
+        "--grade-http-pages",
+        action="store_true",
+        help="visit pages fetched over http again in a browser, to get their fakespot grades",
+    )
+    # save pages as the browser has them, and clean them all at the end
+    parser.add_argument("--raw-capture", action="store_true")
 
-inputs_folder = "inputs"
-user_agents = read_csv(path.join(inputs_folder, "user_agents.csv")).loc[:, "user_agent"]
-queries = read_csv(path.join(inputs_folder, "queries.csv")).loc[:, "query"]
-all_queries = read_csv(path.join(inputs_folder, "all_queries.csv")).loc[:, "query"]
 
-results_folder = "results"
-maybe_create(results_folder)
+def add_parse_options(parser):
+    # the same as product_parser, which is too heavy to import here
+    # lxml skips building a BeautifulSoup tree, so it's faster
+    parser.add_argument("--html-backend", choices=["soup", "lxml"], default="soup")
 
-search_results_folder = path.join(results_folder, "search_results")
-maybe_create(search_results_folder)
 
-duplicate_results_folder = path.join(results_folder, "duplicate_results")
-maybe_create(duplicate_results_folder)
+# only the index needs this
+def add_index_options(parser):
+    # lucene only, so we can read the text back out of the index
+    parser.add_argument("--store-text", action="store_true")
 
-product_pages_folder = path.join(results_folder, "product_pages")
-maybe_create(product_pages_folder)
 
-search_data_file = path.join(results_folder, "search_data.csv")
-duplicates_data_file = path.join(results_folder, "duplicates_data.csv")
-product_ASINs_file = path.join(results_folder, "product_ASINs_data.csv")
-already_searched_file = path.join(results_folder, "already_searched.csv")
+def add_scoring_options(parser):
+    parser.add_argument("--number-of-matches", type=int, default=None)
+    parser.add_argument("--minimum-score", type=float, default=None)
 
-lucene_folder = path.join(results_folder, "lucene")
-maybe_create(lucene_folder)
 
-user_agent_index = 60
+def get_argument_parser():
+    parser = ArgumentParser(description="Scrape and analyze amazon search results")
+    parser.add_argument("--inputs-folder", default=INPUTS_FOLDER)
+    parser.add_argument("--results-folder", default=RESULTS_FOLDER)
+    parser.add_argument(
+        "--table-format", choices=["csv", "parquet"], default=TABLE_FORMAT
+    )
+    stages = parser.add_subparsers(dest="stage", required=True)
 
-# user_agent_index = save_search_pages(
-#     queries,
-#     search_results_folder,
-#      already_searched_file,
-#     user_agents,
-#     user_agent_index=user_agent_index,
-# )
+    search_parser = stages.add_parser("search", help="save search results")
+    add_search_options(search_parser)
+    # e.g. --queries-file all_queries.csv --output-folder duplicate_results --require-complete
+    search_parser.add_argument("--require-complete", action="store_true")
+    add_pipeline_options(search_parser)
+    search_parser.set_defaults(run=run_search)
 
-# combine_folder_csvs(search_results_folder).to_csv(search_data_file, index=False)
+    combine_parser = stages.add_parser(
+        "combine", help="combine a results folder of csvs into one csv"
+    )
+    combine_parser.add_argument("--input-folder", default="search_results")
+    # e.g. --input-folder duplicate_results --output-table duplicates_data
+    combine_parser.add_argument(
+        "--output-table", dest="search_data_table", default=SEARCH_DATA_TABLE
+    )
+    combine_parser.add_argument("--read-threads", type=int, default=READ_THREADS)
+    combine_parser.set_defaults(run=run_combine)
 
+    ASINs_parser = stages.add_parser(
+        "ASINs", help="list the unique ASINs in the search data"
+    )
+    ASINs_parser.add_argument("--search-data-table", default=SEARCH_DATA_TABLE)
+    ASINs_parser.set_defaults(run=run_ASINs)
 
-user_agent_index = save_search_pages(
-    all_queries,
-    duplicate_results_folder,
-    already_searched_file,
-    user_agents,
-    user_agent_index=user_agent_index,
-    require_complete=True
-)
+    products_parser = stages.add_parser("products", help="save product pages")
+    products_parser.add_argument("--threads", type=int, default=THREADS)
+    products_parser.add_argument("--user-agent-index", type=int, default=0)
+    add_pipeline_options(products_parser)
+    add_product_options(products_parser)
+    products_parser.set_defaults(run=run_products)
 
+    clean_parser = stages.add_parser(
+        "clean", help="clean product pages saved with --raw-capture"
+    )
+    clean_parser.add_argument("--processes", type=int, default=PROCESSES)
+    # clean every page, not just new ones
+    clean_parser.add_argument("--reclean", action="store_true")
+    clean_parser.set_defaults(run=run_clean)
 
-combine_folder_csvs(duplicate_results_folder).to_csv(duplicates_data_file, index=False)
+    pack_parser = stages.add_parser(
+        "pack", help="move product pages saved as html files into a packed store"
+    )
+    pack_parser.set_defaults(run=run_pack)
 
-# search_data = read_csv(search_data_file)
+    parse_parser = stages.add_parser("parse", help="parse product pages")
+    parse_parser.add_argument("--processes", type=int, default=PROCESSES)
+    parse_parser.add_argument("--current-year", type=int, default=CURRENT_YEAR)
+    add_parse_options(parse_parser)
+    # compare the backends on every page, instead of parsing
+    parse_parser.add_argument("--cross-check", action="store_true")
+    parse_parser.set_defaults(run=run_parse)
 
-# search_data[["ASIN"]].drop_duplicates().to_csv(product_ASINs_file, index=False)
+    index_parser = stages.add_parser("index", help="index product pages")
+    index_parser.add_argument("--processes", type=int, default=PROCESSES)
+    add_relevance_options(index_parser)
+    add_index_options(index_parser)
+    index_parser.set_defaults(run=run_index)
 
-product_data = read_csv(product_ASINs_file)
+    relevance_parser = stages.add_parser(
+        "relevance", help="score products against the queries"
+    )
+    add_scoring_options(relevance_parser)
+    add_relevance_options(relevance_parser)
+    relevance_parser.set_defaults(run=run_relevance)
 
-# multithread_save_product_pages(
-#     THREADS,
-#     user_agents,
-#     product_data.loc[:, "ASIN"].sample(frac=1),
-#     product_pages_folder,
-# )
+    all_parser = stages.add_parser(
+        "all", help="run every stage that's out of date, in dependency order"
+    )
+    all_parser.add_argument("--skip", nargs="*", choices=STAGE_NAMES, default=[])
+    # run stages even if they look up to date
+    all_parser.add_argument("--force", action="store_true")
+    all_parser.add_argument("--stage-threads", type=int, default=STAGE_THREADS)
+    add_search_options(all_parser)
+    all_parser.add_argument("--search-data-table", default=SEARCH_DATA_TABLE)
+    all_parser.add_argument("--read-threads", type=int, default=READ_THREADS)
+    all_parser.add_argument("--threads", type=int, default=THREADS)
+    add_pipeline_options(all_parser)
+    add_product_options(all_parser)
+    all_parser.add_argument("--processes", type=int, default=PROCESSES)
+    all_parser.add_argument("--current-year", type=int, default=CURRENT_YEAR)
+    add_parse_options(all_parser)
+    add_scoring_options(all_parser)
+    add_relevance_options(all_parser)
+    add_index_options(all_parser)
+    all_parser.set_defaults(run=run_all, require_complete=False, cross_check=False)
 
-parse_product_pages(product_pages_folder, CURRENT_YEAR).to_csv(
-    path.join(results_folder, "product_data.csv"), index = False
-)
+    return parser
 
 
-lucene.initVM(vmargs=["-Djava.awt.headless=true"])
+def main(argv=None):
+    arguments = get_argument_parser().parse_args(argv)
+    arguments.run(arguments)
 
-index_product_pages(lucene_folder, product_pages_folder)
 
-get_relevance_data(lucene_folder, queries, product_data.shape[0]).to_csv(
-    path.join(results_folder, "relevance_data.csv"), index=False
-)
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,82 @@
+# the columns of each output table, in order, with their types
+# so every format, and every reader, agrees on what's in them
+
+# logical types, see table_io for how they're stored
+STRING = "string"
+# strings with only a few different values
+CATEGORY = "category"
+BOOLEAN = "boolean"
+INTEGER = "integer"
+FLOAT = "float"
+DATE = "date"
+
+PRODUCT_SCHEMA = [
+    ("answered_questions", INTEGER),
+    ("amazons_choice", BOOLEAN),
+    ("average_rating", FLOAT),
+    ("best_seller_rank", INTEGER),
+    ("best_seller_category", CATEGORY),
+    ("category", CATEGORY),
+    ("climate_friendly", BOOLEAN),
+    ("coupon_amount", FLOAT),
+    ("fakespot_rating", CATEGORY),
+    ("free_prime_shipping", BOOLEAN),
+    ("free_returns", BOOLEAN),
+    ("limited_stock", BOOLEAN),
+    ("list_price", FLOAT),
+    ("ASIN", STRING),
+    ("new_seller", BOOLEAN),
+    ("number_of_ratings", INTEGER),
+    ("price", FLOAT),
+    ("department", CATEGORY),
+    ("refurbished", BOOLEAN),
+    ("returns", BOOLEAN),
+    ("rush_shipping_available", BOOLEAN),
+    ("ships_from_amazon", BOOLEAN),
+    ("small_business", BOOLEAN),
+    ("sold_by_amazon", BOOLEAN),
+    ("standard_shipping_cost", FLOAT),
+    ("standard_shipping_conditional", BOOLEAN),
+    ("standard_shipping_date_start", DATE),
+    ("standard_shipping_date_end", DATE),
+    ("subscribe_coupon", BOOLEAN),
+    ("subscription_available", BOOLEAN),
+    ("unit", CATEGORY),
+    ("unit_price", FLOAT),
+    ("one_star_percent", INTEGER),
+    ("two_star_percent", INTEGER),
+    ("three_star_percent", INTEGER),
+    ("four_star_percent", INTEGER),
+    ("five_star_percent", INTEGER),
+]
+
+# for search_data and duplicates_data
+SEARCH_SCHEMA = [
+    ("query", CATEGORY),
+    ("page_number", INTEGER),
+    ("page_rank", INTEGER),
+    ("ASIN", STRING),
+    ("sponsored", BOOLEAN),
+    ("amazon_brand", BOOLEAN),
+]
+
+PRODUCT_ASINS_SCHEMA = [("ASIN", STRING)]
+
+# the input files we read columns from
+QUERIES_SCHEMA = [("query", STRING)]
+
+USER_AGENTS_SCHEMA = [("user_agent", STRING)]
+
+RELEVANCE_SCHEMA = [
+    ("query", CATEGORY),
+    ("ASIN", STRING),
+    ("score", FLOAT),
+]
+
+# parquet tables get a folder for each value of these columns
+# so readers can load just the departments they need
+PRODUCT_PARTITION_COLUMNS = ["department"]
+
+
+def get_columns(schema):
+    return [column for column, _ in schema]
@@ -0,0 +1,89 @@
+import json
+from os import fsync, path
+from threading import Lock
+
+# what happened to each query
+SUCCESS = "success"
+# require_complete, but amazon didn't show all the results
+INCOMPLETE = "incomplete"
+TIMEOUT = "timeout"
+WENT_WRONG = "went_wrong"
+# a captcha, so we switched browsers and tried again
+FOILED = "foiled"
+WIFI_DROPPED = "wifi_dropped"
+
+# we won't run these queries again
+# the others get another try next time, starting from their last saved page
+FINISHED_OUTCOMES = {SUCCESS, INCOMPLETE}
+
+
+# an append-only log of every page and query we finish, one json record per line
+# each record is synced to disk before we move on, so a crash loses at most the page in progress
+# page records: query, page_number, rows, next_url, result_counts
+# outcome records: query, outcome
+class SearchJournal:
+    def __init__(self, journal_file):
+        self.lock = Lock()
+        self.finished = set()
+        # query: {page_number: page record}, for queries we haven't finished
+        self.pages = {}
+        # if we crashed in the middle of a record, start the next one on a new line
+        ends_cleanly = True
+        if path.isfile(journal_file):
+            with open(journal_file, "r", encoding="UTF-8") as io:
+                for line in io:
+                    ends_cleanly = line.endswith("\n")
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # half a record, from a crash
+                        continue
+                    self.read_record(record)
+        self.io = open(journal_file, "a", encoding="UTF-8")
+        if not ends_cleanly:
+            self.io.write("\n")
+
+    def read_record(self, record):
+        query = record["query"]
+        if "outcome" in record:
+            if record["outcome"] in FINISHED_OUTCOMES:
+                self.finished.add(query)
+                self.pages.pop(query, None)
+        else:
+            self.pages.setdefault(query, {})[record["page_number"]] = record
+
+    def append(self, record):
+        with self.lock:
+            self.io.write(json.dumps(record) + "\n")
+            self.io.flush()
+            fsync(self.io.fileno())
+            self.read_record(record)
+
+    def is_finished(self, query):
+        with self.lock:
+            return query in self.finished
+
+    # the saved pages of a query, in order
+    def get_pages(self, query):
+        with self.lock:
+            pages = self.pages.get(query, {})
+            return [pages[page_number] for page_number in sorted(pages)]
+
+    # next_url is None on the last page
+    # result_counts are the last result shown and the total number of results, if we checked
+    def save_page(self, query, page_number, rows, next_url, result_counts=None):
+        self.append(
+            {
+                "query": query,
+                "page_number": page_number,
+                "rows": rows,
+                "next_url": next_url,
+                "result_counts": result_counts,
+            }
+        )
+
+    def save_outcome(self, query, outcome):
+        self.append({"query": query, "outcome": outcome})
+
+    def close(self):
+        self.io.close()
@@ -1,5 +1,6 @@
-from os import chdir, path
-from pandas import concat, DataFrame, read_csv
+from concurrent.futures import Future, ThreadPoolExecutor
+from os import path
+from queue import Empty, Queue
 import re
 from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.by import By
@@ -10,19 +11,31 @@ from selenium.webdriver.support.expected_conditions import (
 from selenium.webdriver.support.wait import WebDriverWait as wait
 from time import sleep
 from urllib3.exceptions import ProtocolError
-from urllib.parse import unquote
-
-
-FOLDER = "/home/brandon/amazon_scraper"
-chdir(FOLDER)
+from urllib.parse import unquote, urlencode
+from src.browser import (
+    BrowserPool,
+    SPARE_BROWSERS,
+    get_page,
+    start_loading,
+    wait_for_amazon,
+    wait_times,
+)
+from src.pipeline import PagePipeline
+from src.schemas import get_columns, SEARCH_SCHEMA
+from src.search_journal import (
+    FOILED,
+    INCOMPLETE,
+    SearchJournal,
+    SUCCESS,
+    TIMEOUT,
+    WENT_WRONG,
+    WIFI_DROPPED,
+)
 from src.utilities import (
+    clean_html,
     FoiledAgainError,
-    get_clean_soup,
-    get_filenames,
-    new_browser,
     only,
-    switch_user_agent,
-    wait_for_amazon,
+    RowAccumulator,
     WentWrongError,
 )
 
@@ -34,12 +47,24 @@ class NoASINError(Exception):
     pass
 
 
+# each browser needs a user agent to start with
+class NoUserAgentsError(Exception):
+    pass
+
+
+class NoBrowsersError(Exception):
+    pass
+
+
 URL_PATTERN = r".*\/dp\/([^/]*)\/"
 
+# columns of the search data, in order
+SEARCH_COLUMNS = get_columns(SEARCH_SCHEMA)
+
 
 # index = 0
 # file = open(path.join(search_results_folder, query + ".html"), "r", encoding='UTF-8')
-# search_result = read_html(search_results_folder, query).select("div.s-main-slot.s-result-list > div[data-component-type='s-search-result']")[index]
+# search_result = parse_html(file.read()).select("div.s-main-slot.s-result-list > div[data-component-type='s-search-result']")[index]
 # file.close()
 def parse_search_result(query, search_result, page_number, index):
     sponsored = False
@@ -75,23 +100,22 @@ def parse_search_result(query, search_result, page_number, index):
     else:
         amazon_brand = False
 
-    return DataFrame(
-        {
-            "query": [query],
-            "page_number": [page_number],
-            "page_rank": [index + 1],
-            "ASIN": [ASIN],
-            "sponsored": [sponsored],
-            "amazon_brand": [amazon_brand],
-        }
-    )
+    return {
+        "query": query,
+        "page_number": page_number,
+        "page_rank": index + 1,
+        "ASIN": ASIN,
+        "sponsored": sponsored,
+        "amazon_brand": amazon_brand,
+    }
 
 
-def add_page(page_tables, browser, query, page_number):
-    page_tables.append(concat(
+# returns the rows for one page of results
+def parse_search_page(query, page_number, page_source):
+    return [
         parse_search_result(query, search_result, page_number, index)
         for index, search_result in enumerate(
-            get_clean_soup(browser).select(
+            clean_html(page_source).select(
                 ", ".join(
                     [
                         "div.s-main-slot.s-result-list > div[data-component-type='s-search-result']",
@@ -100,7 +124,30 @@ def add_page(page_tables, browser, query, page_number):
                 )
             )
         )
-    ))
+    ]
+
+
+# with a pipeline, parse in another process, and keep a future for the rows instead
+def add_page(page_rows, page_source, query, page_number, pipeline=None):
+    if pipeline is None:
+        page_rows.append(parse_search_page(query, page_number, page_source))
+    else:
+        page_rows.append(
+            pipeline.submit(parse_search_page, query, page_number, page_source)
+        )
+
+
+# combine the pages in order, waiting for any still being parsed
+def write_search_results(search_results_folder, query, page_rows):
+    search_rows = RowAccumulator(SEARCH_COLUMNS)
+    for rows in page_rows:
+        if isinstance(rows, Future):
+            rows = rows.result()
+        for row in rows:
+            search_rows.append(row)
+    search_rows.to_data_frame().to_csv(
+        path.join(search_results_folder, query + ".csv"), index = False
+    )
 
 def get_next_page_buttons(browser, page_number):
     return browser.find_elements(By.CSS_SELECTOR, "a[aria-label='Go to page " + str(page_number) + "']")
@@ -117,12 +164,106 @@ def go_to_amazon(browser):
         browser.get(url)
         wait_for_amazon(browser)
 
+# how to get from one page of results to the next
+# click the buttons, like a person would
+CLICK_NAVIGATION = "click"
+# load the search urls directly, so we can load the next page while we parse this one
+URL_NAVIGATION = "url"
+
+
+def get_search_url(query, page_number):
+    return "https://www.amazon.com/s?" + urlencode({"k": query, "page": page_number})
+
+
 RESULT_COUNT_SELECTOR = "div[data-cel-widget='UPPER-RESULT_INFO_BAR-0'] div.s-breadcrumb div.a-spacing-top-small span:first-child"
 
 def get_result_count_match(browser):
     wait(browser, 2).until(located((By.CSS_SELECTOR, RESULT_COUNT_SELECTOR)))
     return re.fullmatch("\d+-(\d+) of (\d+) results for", only(browser.find_elements(By.CSS_SELECTOR, RESULT_COUNT_SELECTOR)).text)
 
+# once the rows are parsed, save the page to the journal
+def save_search_page(journal, query, page_number, rows, next_url, result_counts):
+    if isinstance(rows, Future):
+        rows = rows.result()
+    journal.save_page(query, page_number, rows, next_url, result_counts)
+
+
+# only mark the query done once its results are written
+def finish_search_results(search_results_folder, journal, query, page_rows):
+    try:
+        write_search_results(search_results_folder, query, page_rows)
+    except Exception:
+        # it's not marked done, so we'll search it again next time
+        print(query)
+        print("Couldn't save results")
+        raise
+    journal.save_outcome(query, SUCCESS)
+
+
+# with a pipeline, wait for the writer to save the pages before it
+def save_outcome(journal, query, outcome, pipeline=None):
+    if pipeline is None:
+        journal.save_outcome(query, outcome)
+    else:
+        pipeline.write(journal.save_outcome, query, outcome)
+
+
+# look at the page the browser is on
+# returns the url of the next page, or None if this is the last page, and the result counts
+# or None if require_complete and amazon won't say how many results there are
+def get_page_checkpoint(browser, query, page_number, require_complete, navigation):
+    result_counts = None
+    if require_complete:
+        result_count_match = get_result_count_match(browser)
+        if result_count_match is None:
+            return None
+        result_counts = [result_count_match.group(1), result_count_match.group(2)]
+
+    next_url = None
+    next_page_buttons = get_next_page_buttons(browser, page_number + 1)
+    if next_page_buttons:
+        if navigation == URL_NAVIGATION:
+            next_url = get_search_url(query, page_number + 1)
+        else:
+            next_url = only(next_page_buttons).get_attribute("href")
+    return next_url, result_counts
+
+
+# parse the page, and save it to the journal
+def checkpoint_page(
+    journal,
+    query,
+    page_number,
+    page_rows,
+    page_source,
+    next_url,
+    result_counts,
+    pipeline=None,
+):
+    add_page(page_rows, page_source, query, page_number, pipeline)
+    if pipeline is None:
+        journal.save_page(query, page_number, page_rows[-1], next_url, result_counts)
+    else:
+        pipeline.write(
+            save_search_page,
+            journal,
+            query,
+            page_number,
+            page_rows[-1],
+            next_url,
+            result_counts,
+        )
+
+
+# returns the page we're leaving, for wait_for_amazon
+def go_to_next_page(browser, page_number, next_url, navigation):
+    if navigation == URL_NAVIGATION:
+        return start_loading(browser, next_url)
+    old_page = get_page(browser)
+    only(get_next_page_buttons(browser, page_number + 1)).click()
+    return old_page
+
+
 # query = "laptop"
 # browser = new_browser("Mozilla/5.0 (X11; OpenBSD amd64; rv:28.0) Gecko/20100101 Firefox/28.0", fakespot = True)
 # go_to_amazon(browser)
@@ -131,141 +272,275 @@ def run_query(
     browser,
     query,
     search_results_folder,
-    already_searched,
-    require_complete
+    journal,
+    require_complete,
+    pipeline=None,
+    navigation=CLICK_NAVIGATION,
 ):
-    search_bar = only(browser.find_elements(By.CSS_SELECTOR, "#twotabsearchtextbox"))
-
-    search_bar.clear()
-    search_bar.send_keys(query)
-    search_bar.send_keys(Keys.RETURN)
-
-    # wait until a new page starts loading
-    wait_for_amazon(browser)
+    # start from the pages we saved last time, if any
+    saved_pages = journal.get_pages(query)
+    page_rows = [saved_page["rows"] for saved_page in saved_pages]
+    old_page = None
+    if saved_pages:
+        last_page = saved_pages[-1]
+        page_number = last_page["page_number"]
+        next_url = last_page["next_url"]
+        result_counts = last_page["result_counts"]
+        more_pages = not next_url is None
+        if more_pages:
+            # go straight to the first page we haven't saved
+            old_page = start_loading(browser, next_url)
+    else:
+        page_number = 0
+        more_pages = True
+        if navigation == URL_NAVIGATION:
+            old_page = start_loading(browser, get_search_url(query, 1))
+        else:
+            search_bar = only(browser.find_elements(By.CSS_SELECTOR, "#twotabsearchtextbox"))
 
-    # the CSS selector is for all the parts we don't need
-    # save the page to the folder
-    page_number = 1
+            search_bar.clear()
+            search_bar.send_keys(query)
+            old_page = get_page(browser)
+            search_bar.send_keys(Keys.RETURN)
 
-    page_tables = []
-    
-    add_page(page_tables, browser, query, page_number)
-    page_number = page_number + 1
-    if require_complete and get_result_count_match(browser) is None:
-        already_searched.add(query)
-        return
-    next_page_buttons = get_next_page_buttons(browser, page_number)
-    while next_page_buttons:
-        if not next_page_buttons:
-            print(str(page_number))
-        only(next_page_buttons).click()
-        wait_for_amazon(browser)
-        if require_complete and get_result_count_match(browser) is None:
-            already_searched.add(query)
-            return
-        add_page(page_tables, browser, query, page_number)
+    while more_pages:
+        # wait until the new page loads
+        wait_for_amazon(browser, old_page)
         page_number = page_number + 1
-        next_page_buttons = get_next_page_buttons(browser, page_number)
-    
-    all_together = concat(page_tables)
-    if require_complete:
-        result_count_match = get_result_count_match(browser)
-        if result_count_match is None:
-            already_searched.add(query)
-            return
-        if result_count_match.group(1) != result_count_match.group(2):
-            already_searched.add(query)
+        # save the html before we leave the page
+        page_source = browser.page_source
+        checkpoint = get_page_checkpoint(
+            browser, query, page_number, require_complete, navigation
+        )
+        if checkpoint is None:
+            save_outcome(journal, query, INCOMPLETE, pipeline)
             return
-    
-    all_together.to_csv(path.join(search_results_folder, query + ".csv"), index = False)
+        (next_url, result_counts) = checkpoint
+        more_pages = not next_url is None
+        if more_pages:
+            # the browser loads the next page while we parse this one
+            old_page = go_to_next_page(browser, page_number, next_url, navigation)
+        checkpoint_page(
+            journal,
+            query,
+            page_number,
+            page_rows,
+            page_source,
+            next_url,
+            result_counts,
+            pipeline,
+        )
 
-def run_query_save(
+    if require_complete and (
+        result_counts is None or result_counts[0] != result_counts[1]
+    ):
+        save_outcome(journal, query, INCOMPLETE, pipeline)
+        return
+
+    if pipeline is None:
+        finish_search_results(search_results_folder, journal, query, page_rows)
+    else:
+        # the writer waits for the pages to be parsed, so we can move on to the next query
+        pipeline.write(
+            finish_search_results, search_results_folder, journal, query, page_rows
+        )
+
+
+# search one query, skipping it if something goes wrong
+# returns the browser to use next, which is new if we had to switch or recycle it
+def search_query(
+    browser_pool,
     browser,
     query,
     search_results_folder,
-    already_searched,
-    already_searched_file,
-    require_complete
-):
-    run_query(
-        browser,
-        query,
-        search_results_folder,
-        already_searched,
-        require_complete
-    )
-    DataFrame({"query": list(already_searched)}).to_csv(already_searched_file, index = False)
-    
-
-def save_search_pages(
-    queries,
-    search_results_folder,
-    already_searched_file,
-    user_agents,
-    user_agent_index=0,
-    require_complete=False
+    journal,
+    require_complete,
+    pipeline=None,
+    navigation=CLICK_NAVIGATION,
 ):
-    browser = new_browser(user_agents[user_agent_index])
-
-    already_searched = set(read_csv(already_searched_file).loc[:, "query"])
-
-    go_to_amazon(browser)
-
-    # empty because there was no previous searched query
-    # query = "chemistry textbook"
-    # department = "Books"
-    for query in queries:
-        # don't rerun a query we already ran
-        if query in already_searched:
-            continue
+    try:
+        run_query(
+            browser,
+            query,
+            search_results_folder,
+            journal,
+            require_complete,
+            pipeline,
+            navigation,
+        )
+    except FoiledAgainError:
+        save_outcome(journal, query, FOILED, pipeline)
+        browser = browser_pool.switch(browser)
+        go_to_amazon(browser)
+        # the pages we already got might still be waiting to be written to the journal
+        if not pipeline is None:
+            pipeline.flush()
 
         try:
-            run_query_save(
+            # picks up from the last page we saved
+            run_query(
                 browser,
                 query,
                 search_results_folder,
-                already_searched,
-                already_searched_file,
-                require_complete
-            )
-        except FoiledAgainError:
-            browser, user_agent_index = switch_user_agent(
-                browser, user_agents, user_agent_index
+                journal,
+                require_complete,
+                pipeline,
+                navigation,
             )
-            go_to_amazon(browser)
-
-            try:
-                run_query_save(
-                    browser,
-                    query,
-                    search_results_folder,
-                    already_searched,
-                    already_searched_file,
-                    require_complete
-                )
-            except ProtocolError:
-                print("WiFi dropped, sleeping and skipping")
-                sleep(60)
-            except TimeoutException:
-                print(query)
-                print("Timeout, skipping")
-            except WentWrongError:
-                print(query)
-                print("Went wrong, skipping")
-                # we need to go back to amazon so we can keep searching
-                go_to_amazon(browser)
         except ProtocolError:
+            save_outcome(journal, query, WIFI_DROPPED, pipeline)
             print("WiFi dropped, sleeping and skipping")
             sleep(60)
         except TimeoutException:
+            save_outcome(journal, query, TIMEOUT, pipeline)
             print(query)
             print("Timeout, skipping")
         except WentWrongError:
+            save_outcome(journal, query, WENT_WRONG, pipeline)
             print(query)
             print("Went wrong, skipping")
             # we need to go back to amazon so we can keep searching
             go_to_amazon(browser)
+    except ProtocolError:
+        save_outcome(journal, query, WIFI_DROPPED, pipeline)
+        print("WiFi dropped, sleeping and skipping")
+        sleep(60)
+    except TimeoutException:
+        save_outcome(journal, query, TIMEOUT, pipeline)
+        print(query)
+        print("Timeout, skipping")
+    except WentWrongError:
+        save_outcome(journal, query, WENT_WRONG, pipeline)
+        print(query)
+        print("Went wrong, skipping")
+        # we need to go back to amazon so we can keep searching
+        go_to_amazon(browser)
+
+    # swap out old or crashed browsers
+    recycled_browser = browser_pool.recycle(browser)
+    if not recycled_browser is browser:
+        browser = recycled_browser
+        go_to_amazon(browser)
+
+    return browser
+
+
+# each browser takes the next query from the queue until there are none left
+def search_queue(
+    thread_id,
+    query_queue,
+    search_results_folder,
+    journal,
+    browser_pool,
+    require_complete,
+    pipeline=None,
+    navigation=CLICK_NAVIGATION,
+):
+    browser = browser_pool.get()
+    go_to_amazon(browser)
+
+    while True:
+        try:
+            query = query_queue.get_nowait()
+        except Empty:
+            break
+        # don't rerun a query we already finished
+        if journal.is_finished(query):
+            continue
+        browser = search_query(
+            browser_pool,
+            browser,
+            query,
+            search_results_folder,
+            journal,
+            require_complete,
+            pipeline,
+            navigation,
+        )
 
-    browser.close()
+    browser_pool.release(browser)
+    print("finished thread {0:d}!".format(thread_id))
 
-    return user_agent_index
+
+# split the user agents into one slice for each browser, in order
+def get_user_agent_slices(user_agents, browsers):
+    user_agents = list(user_agents)
+    bounds = [len(user_agents) * index // browsers for index in range(browsers + 1)]
+    return [user_agents[bounds[index] : bounds[index + 1]] for index in range(browsers)]
+
+
+# with more than one browser, each gets its own slice of the user agents
+# and user_agent_index is the index within each slice
+def save_search_pages(
+    queries,
+    search_results_folder,
+    journal_file,
+    user_agents,
+    user_agent_index=0,
+    require_complete=False,
+    pipeline_processes=None,
+    browsers=1,
+    spare_browsers=SPARE_BROWSERS,
+    navigation=CLICK_NAVIGATION,
+):
+    if len(user_agents) == 0:
+        raise NoUserAgentsError("user_agents.csv has no user agents")
+    if browsers < 1:
+        raise NoBrowsersError(browsers)
+    # every browser needs at least one user agent
+    browsers = min(browsers, len(user_agents))
+    browser_pools = [
+        BrowserPool(user_agent_slice, user_agent_index, spare_browsers=spare_browsers)
+        for user_agent_slice in get_user_agent_slices(user_agents, browsers)
+    ]
+
+    pipeline = None
+    journal = None
+    # close everything even if a browser thread fails
+    # otherwise the pipeline's writer thread keeps the process alive, and firefox is left running
+    try:
+        # parse and write results in the background, while the browsers keep searching
+        if not pipeline_processes is None:
+            pipeline = PagePipeline(pipeline_processes)
+
+        journal = SearchJournal(journal_file)
+
+        # the browsers take queries in the same order as they're listed
+        query_queue = Queue()
+        queued = set()
+        for query in queries:
+            if not query in queued and not journal.is_finished(query):
+                query_queue.put(query)
+                queued.add(query)
+
+        # empty because there was no previous searched query
+        # query = "chemistry textbook"
+        # department = "Books"
+        with ThreadPoolExecutor(browsers) as executor:
+            # list to raise any errors from the threads
+            list(
+                executor.map(
+                    lambda thread_id: search_queue(
+                        thread_id,
+                        query_queue,
+                        search_results_folder,
+                        journal,
+                        browser_pools[thread_id],
+                        require_complete,
+                        pipeline,
+                        navigation,
+                    ),
+                    range(browsers),
+                )
+            )
+    finally:
+        for browser_pool in browser_pools:
+            browser_pool.close()
+        if not pipeline is None:
+            pipeline.close()
+        if not journal is None:
+            journal.close()
+    wait_times.report()
+
+    # the furthest any browser got through its slice
+    return max(browser_pool.user_agent_index for browser_pool in browser_pools)
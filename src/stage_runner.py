@@ -0,0 +1,178 @@
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from hashlib import sha256
+from os import path, replace, stat, walk
+import pickle
+from threading import Lock
+from time import perf_counter
+
+# name: what to call the stage
+# run: a function with no arguments
+# inputs: files and folders the stage reads
+# outputs: files and folders the stage writes
+# a stage waits for the stages that write its inputs
+Stage = namedtuple("Stage", ["name", "run", "inputs", "outputs"])
+
+# read files in blocks this big to hash them
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+# error if stages are waiting on each other
+class CircularDependencyError(Exception):
+    pass
+
+
+# all the files in a folder, or just the file
+def get_files(file_or_folder):
+    if path.isdir(file_or_folder):
+        return sorted(
+            path.join(folder, filename)
+            for folder, _, filenames in walk(file_or_folder)
+            for filename in filenames
+        )
+    if path.isfile(file_or_folder):
+        return [file_or_folder]
+    return []
+
+
+# when the file, or any file in the folder, last changed
+# None if there's nothing there
+def get_last_modified(file_or_folder):
+    files = get_files(file_or_folder)
+    if not files:
+        return None
+    return max(stat(file).st_mtime_ns for file in files)
+
+
+# folders can hold hundreds of thousands of pages, so only hash their names, sizes and times
+# files get hashed in full, so rewriting the same contents doesn't count as a change
+def get_inputs_hash(inputs):
+    inputs_hash = sha256()
+    for input in inputs:
+        inputs_hash.update(input.encode("UTF-8"))
+        if path.isdir(input):
+            for file in get_files(input):
+                file_stats = stat(file)
+                inputs_hash.update(
+                    "{0}\t{1:d}\t{2:d}\n".format(
+                        path.relpath(file, input),
+                        file_stats.st_size,
+                        file_stats.st_mtime_ns,
+                    ).encode("UTF-8")
+                )
+        elif path.isfile(input):
+            with open(input, "rb") as io:
+                for block in iter(lambda: io.read(HASH_BLOCK_SIZE), b""):
+                    inputs_hash.update(block)
+    return inputs_hash.hexdigest()
+
+
+# stage name: hash of its inputs, the last time it ran
+def read_stage_state(stage_state_file):
+    if not path.isfile(stage_state_file):
+        return {}
+    with open(stage_state_file, "rb") as io:
+        return pickle.load(io)
+
+
+def write_stage_state(stage_state, stage_state_file):
+    temporary_file = stage_state_file + ".tmp"
+    with open(temporary_file, "wb") as io:
+        pickle.dump(stage_state, io)
+    # so a crash never leaves half a file
+    replace(temporary_file, stage_state_file)
+
+
+# a stage is up to date if it finished last time it ran, and either its outputs are newer than its inputs
+# or its inputs haven't changed since
+# a stage that never finished leaves half-written outputs, which can still look newer than its inputs
+def is_up_to_date(stage, inputs_hash, last_inputs_hash):
+    if last_inputs_hash is None:
+        return False
+    output_times = [get_last_modified(output) for output in stage.outputs]
+    if any(output_time is None for output_time in output_times):
+        return False
+    input_times = [get_last_modified(input) for input in stage.inputs]
+    if any(input_time is None for input_time in input_times):
+        return False
+    if not input_times or max(input_times) <= min(output_times):
+        return True
+    return inputs_hash == last_inputs_hash
+
+
+# returns the inputs hash, and whether we actually ran the stage
+# call start before running, so we can forget the last run
+def run_stage(stage, last_inputs_hash, force, start):
+    inputs_hash = get_inputs_hash(stage.inputs)
+    if not force and is_up_to_date(stage, inputs_hash, last_inputs_hash):
+        print("{0}: up to date, skipping".format(stage.name))
+        return inputs_hash, False
+    start(stage)
+    print("{0}: running".format(stage.name))
+    start_time = perf_counter()
+    stage.run()
+    print("{0}: done in {1:.1f}s".format(stage.name, perf_counter() - start_time))
+    return inputs_hash, True
+
+
+# run each stage once the stages it depends on are done
+# stages that don't depend on each other run at the same time
+def run_stages(stages, stage_state_file, threads, force=False):
+    start_time = perf_counter()
+    stage_state = read_stage_state(stage_state_file)
+    # stages start on other threads
+    stage_state_lock = Lock()
+
+    # if we stop in the middle of a stage, it will run again next time
+    def start(stage):
+        with stage_state_lock:
+            if not stage_state.pop(stage.name, None) is None:
+                write_stage_state(stage_state, stage_state_file)
+
+    writers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            writers[output] = stage.name
+    dependencies = {
+        stage.name: set(
+            writers[input]
+            for input in stage.inputs
+            if input in writers and writers[input] != stage.name
+        )
+        for stage in stages
+    }
+
+    finished = set()
+    waiting = list(stages)
+    running = {}
+    with ThreadPoolExecutor(threads) as executor:
+        while waiting or running:
+            for stage in list(waiting):
+                if dependencies[stage.name].issubset(finished):
+                    waiting.remove(stage)
+                    running[
+                        executor.submit(
+                            run_stage,
+                            stage,
+                            stage_state.get(stage.name),
+                            force,
+                            start,
+                        )
+                    ] = stage
+            if not running:
+                # nothing can run, so some stages depend on each other
+                raise CircularDependencyError(
+                    ", ".join(stage.name for stage in waiting)
+                )
+            (done, _) = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                # raise any errors from the stage
+                # so we only record stages that finished
+                (inputs_hash, _) = future.result()
+                with stage_state_lock:
+                    stage_state[stage.name] = inputs_hash
+                    write_stage_state(stage_state, stage_state_file)
+                finished.add(stage.name)
+
+    print("All stages done in {0:.1f}s".format(perf_counter() - start_time))
@@ -0,0 +1,218 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from os import listdir, path, replace
+from pandas import DataFrame, concat, read_csv, read_parquet, to_datetime
+from shutil import rmtree
+from src.schemas import BOOLEAN, CATEGORY, DATE, FLOAT, INTEGER, STRING, get_columns
+
+# the format of a table file comes from its extension
+CSV_FORMAT = ".csv"
+PARQUET_FORMAT = ".parquet"
+
+# how many files to read at once
+READ_THREADS = 8
+
+# how many files to hold in memory before writing them out
+FILES_PER_CHUNK = 1000
+
+
+class UnknownFormatError(Exception):
+    pass
+
+
+# nullable pandas types, so missing values don't turn integers and booleans into floats
+PANDAS_TYPES = {
+    STRING: "string",
+    CATEGORY: "category",
+    BOOLEAN: "boolean",
+    INTEGER: "Int64",
+    FLOAT: "float64",
+    DATE: "datetime64[ns]",
+}
+
+
+# convert each column to the type the schema says it should be
+def apply_schema(data_frame, schema):
+    for column, column_type in schema:
+        if not column in data_frame.columns:
+            continue
+        if column_type == DATE:
+            data_frame[column] = to_datetime(data_frame[column])
+        else:
+            data_frame[column] = data_frame[column].astype(PANDAS_TYPES[column_type])
+    return data_frame
+
+
+def get_arrow_schema(schema):
+    import pyarrow
+
+    arrow_types = {
+        STRING: pyarrow.string(),
+        CATEGORY: pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+        BOOLEAN: pyarrow.bool_(),
+        INTEGER: pyarrow.int64(),
+        FLOAT: pyarrow.float64(),
+        # just the day, no time
+        DATE: pyarrow.date32(),
+    }
+    return pyarrow.schema(
+        [(column, arrow_types[column_type]) for column, column_type in schema]
+    )
+
+
+# replace the old file or folder with the new one, all at once
+def replace_output(temporary_file, file):
+    if path.isdir(file):
+        rmtree(file)
+    replace(temporary_file, file)
+
+
+def get_table_format(file):
+    table_format = path.splitext(file)[1]
+    if not table_format in (CSV_FORMAT, PARQUET_FORMAT):
+        raise UnknownFormatError(file)
+    return table_format
+
+
+# columns = None for all the columns
+# parquet only reads the columns we ask for off the disk
+# and already knows its types, csvs need the schema to get them back
+def read_table(file, columns=None, schema=None):
+    if get_table_format(file) == PARQUET_FORMAT:
+        data_frame = read_parquet(file, columns=columns)
+        if schema is None:
+            return data_frame
+        # parquet dates come back as python dates, so match the csvs
+        return apply_schema(data_frame, schema)
+    return read_csv_table(file, columns, schema)
+
+
+# without the schema, pandas guesses the types of each file on its own
+# so ASINs lose leading zeros, and a column can be numbers in one file and text in the next
+def read_csv_table(file, columns=None, schema=None):
+    if schema is None:
+        return read_csv(file, usecols=columns)
+    return apply_schema(
+        read_csv(
+            file,
+            usecols=columns,
+            dtype={
+                column: PANDAS_TYPES[column_type]
+                for column, column_type in schema
+                if column_type != DATE
+            },
+        ),
+        schema,
+    )
+
+
+# the whole table at once
+# parquet tables with partition columns are a folder, with a folder for each value
+def write_table(data_frame, file, schema=None, partition_columns=None):
+    if not schema is None:
+        apply_schema(data_frame, schema)
+    temporary_file = file + ".tmp"
+    if get_table_format(file) == PARQUET_FORMAT:
+        import pyarrow
+        from pyarrow import parquet
+
+        if schema is None:
+            table = pyarrow.Table.from_pandas(data_frame, preserve_index=False)
+        else:
+            table = pyarrow.Table.from_pandas(
+                data_frame, schema=get_arrow_schema(schema), preserve_index=False
+            )
+        if partition_columns is None:
+            parquet.write_table(table, temporary_file)
+        else:
+            parquet.write_to_dataset(
+                table, temporary_file, partition_cols=partition_columns
+            )
+    else:
+        data_frame.to_csv(temporary_file, index=False)
+    replace_output(temporary_file, file)
+
+
+# write a table one chunk at a time, so we never hold the whole thing
+# without a schema, the first chunk decides the types
+class TableWriter:
+    def __init__(self, file, schema=None):
+        self.file = file
+        self.table_format = get_table_format(file)
+        # write next to the file, and only replace it once we're done
+        self.temporary_file = file + ".tmp"
+        self.io = None
+        self.declared_schema = schema
+        self.schema = None
+        if not schema is None and self.table_format == PARQUET_FORMAT:
+            self.schema = get_arrow_schema(schema)
+
+    def write(self, data_frame):
+        if not self.declared_schema is None:
+            apply_schema(data_frame, self.declared_schema)
+        if self.table_format == PARQUET_FORMAT:
+            self.write_parquet(data_frame)
+        else:
+            self.write_csv(data_frame)
+
+    def write_csv(self, data_frame):
+        if self.io is None:
+            self.io = open(self.temporary_file, "w", encoding="UTF-8", newline="")
+            data_frame.to_csv(self.io, index=False)
+        else:
+            data_frame.to_csv(self.io, header=False, index=False)
+
+    def write_parquet(self, data_frame):
+        # parquet needs pyarrow, but csvs don't
+        import pyarrow
+        from pyarrow import parquet
+
+        if self.schema is None:
+            self.schema = pyarrow.Table.from_pandas(
+                data_frame, preserve_index=False
+            ).schema
+        if self.io is None:
+            self.io = parquet.ParquetWriter(self.temporary_file, self.schema)
+        # a chunk with missing values might have come in as floats instead of integers
+        # so convert everything to the same types
+        self.io.write_table(
+            pyarrow.Table.from_pandas(
+                data_frame, schema=self.schema, preserve_index=False
+            )
+        )
+
+    def close(self):
+        if self.io is None:
+            return
+        self.io.close()
+        replace_output(self.temporary_file, self.file)
+
+
+# stream all the csvs in a folder into one table file, csv or parquet
+# read files in parallel, a chunk at a time, so memory stays flat as the folder grows
+def save_folder_csvs(
+    folder,
+    output_file,
+    schema=None,
+    threads=READ_THREADS,
+    files_per_chunk=FILES_PER_CHUNK,
+):
+    files = sorted(path.join(folder, file) for file in listdir(folder))
+    table_writer = TableWriter(output_file, schema)
+    if not files:
+        # still write the table, so later stages find it
+        table_writer.write(
+            DataFrame(columns=[] if schema is None else get_columns(schema))
+        )
+    with ThreadPoolExecutor(threads) as executor:
+        for index in range(0, len(files), files_per_chunk):
+            table_writer.write(
+                concat(
+                    executor.map(
+                        partial(read_csv_table, schema=schema),
+                        files[index : index + files_per_chunk],
+                    ),
+                    ignore_index=True,
+                )
+            )
+    table_writer.close()
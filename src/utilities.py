@@ -1,18 +1,9 @@
 from bs4 import BeautifulSoup, Comment, NavigableString
 from os import listdir, mkdir, path
 import re
-from pandas import concat, read_csv
-from selenium import webdriver
-from selenium.common.exceptions import TimeoutException
-from selenium.webdriver.common.by import By
-from selenium.webdriver.firefox.options import Options
-from selenium.webdriver.support.expected_conditions import (
-    presence_of_element_located as located,
-    invisibility_of_element_located as not_located,
-)
-from selenium.webdriver.support.wait import WebDriverWait as wait
-
-HEADLESS = False
+from pandas import DataFrame, Series
+import soupsieve
+from time import perf_counter
 
 JUNK_SELECTORS = [
     "iframe",
@@ -59,9 +50,6 @@ JUNK_SELECTORS = [
 # time for timed waits
 WAIT_TIME = 20
 
-FAKESPOT_FILE = "/home/brandon/snap/firefox/common/.mozilla/firefox/fi1pyptz.default/extensions/{44df5123-f715-9146-bfaa-c6e8d4461d44}.xpi"
-
-
 # custom error if amazon stops us with captcha
 class FoiledAgainError(Exception):
     pass
@@ -91,56 +79,44 @@ def only(list):
     return list[0]
 
 
-def new_browser(user_agent, fakespot=False):
-    options = Options()
-    # add headless to avoid the visual display and speed things up
-    if HEADLESS:
-        options.add_argument("-headless")
-    options.set_preference("general.useragent.override", user_agent)
-    # this helps pages load faster I guess?
-    options.set_capability("pageLoadStrategy", "eager")
-
-    browser = webdriver.Firefox(options=options)
-    # selenium sputters when scripts run too long so set a timeout
-    browser.set_script_timeout(WAIT_TIME)
-    # throw an error if we wait too long
-    browser.set_page_load_timeout(WAIT_TIME)
-    if fakespot:
-        browser.execute("INSTALL_ADDON", {"path": FAKESPOT_FILE, "temporary": True})
-        # wait for fakespot to open a new tab
-        wait(browser, WAIT_TIME).until(lambda browser: len(browser.window_handles) > 1)
-        # close it
-        browser.switch_to.window(browser.window_handles[1])
-        browser.close()
-        # return to main tab
-        browser.switch_to.window(browser.window_handles[0])
-
-    return browser
-
-
-def switch_user_agent(browser, user_agents, user_agent_index):
-    browser.close()
-    # if Amazon sends a captcha, change the user agent and try again
-    if user_agent_index == len(user_agents) - 1:
-        # start again if we're at the end
-        new_user_agent_index = 0
-    else:
-        new_user_agent_index = user_agent_index + 1
-
-    return (
-        new_browser(user_agents[new_user_agent_index], fakespot=True),
-        new_user_agent_index,
-    )
-
-
-# combine all the csvs in a folder into a dataframe
-def combine_folder_csvs(folder):
-    return concat(
-        (
-            read_csv(path.join(folder, file))
-            for file in listdir(folder)
+# collect rows column by column, then build one dataframe at the end
+# much cheaper than making a one-row dataframe for every row and concatenating
+class RowAccumulator:
+    def __init__(self, columns):
+        self.columns = columns
+        self.column_data = {column: [] for column in columns}
+
+    def __len__(self):
+        return len(self.column_data[self.columns[0]])
+
+    # get back each row as a dictionary
+    def __iter__(self):
+        for values in zip(*(self.column_data[column] for column in self.columns)):
+            yield dict(zip(self.columns, values))
+
+    # row is a dictionary with a value for every column
+    def append(self, row):
+        for column in self.columns:
+            self.column_data[column].append(row[column])
+
+    # add all the rows from another accumulator with the same columns
+    def extend(self, other):
+        for column in self.columns:
+            self.column_data[column].extend(other.column_data[column])
+
+    def to_data_frame(self):
+        # columns with missing values stay as objects, like concatenating one-row dataframes
+        # otherwise whole numbers with missing values would be written as floats
+        return DataFrame(
+            {
+                column: Series(
+                    values,
+                    dtype=object if any(value is None for value in values) else None,
+                )
+                for column, values in self.column_data.items()
+            },
+            columns=self.columns,
         )
-    )
 
 
 # get the filenames in a folder, sans file extension
@@ -165,10 +141,9 @@ def remove_whitespace(soup):
         elif text != stripped:
             text.replace_with(stripped)
 
-def get_clean_soup(browser):
-    soup = BeautifulSoup(
-        browser.page_source.encode("utf-8"), "lxml", from_encoding="UTF-8"
-    )
+# the old way, one pass over the page for each step
+# kept to check and benchmark clean_soup against
+def clean_soup_in_passes(soup):
     for junk in soup.select(", ".join(JUNK_SELECTORS)):
         junk.extract()
     for comment in soup(text=lambda text: isinstance(text, Comment)):
@@ -178,59 +153,126 @@ def get_clean_soup(browser):
     for div in soup.select("div"):
         if is_empty_div(div):
             div.extract()
-    return soup
 
 
-# soup = product_page
-def save_browser(browser, filename):
-    with open(filename, "w", encoding="UTF-8") as io:
-        io.write(get_clean_soup(browser).prettify())
+# e.g. "div#navFooter", "#navFooter", "div.fs-privacy-notice", or "iframe"
+SIMPLE_SELECTOR_PATTERN = r"([a-z]*)(?:#([\w-]+))?(?:\.([\w-]+))?"
 
 
-def wait_for_amazon(browser):
-    try:
-        # wait a couple of seconds for a new page to start loading
-        wait(browser, 2).until(not_located((By.CSS_SELECTOR, "#navFooter")))
-    except TimeoutException:
-        # if we time out, its already loaded
-        pass
+# sort the junk selectors by id, class, and tag, so we can check each tag quickly
+def compile_junk_selectors(junk_selectors):
+    junk_ids = {}
+    junk_classes = {}
+    junk_tag_names = set()
+    other_junk_selectors = []
+    for selector in junk_selectors:
+        match = re.fullmatch(SIMPLE_SELECTOR_PATTERN, selector)
+        if match is None:
+            other_junk_selectors.append(soupsieve.compile(selector))
+            continue
+        (tag_name, tag_id, tag_class) = match.groups()
+        if not tag_id is None:
+            junk_ids.setdefault(tag_id, set()).add(tag_name)
+        elif not tag_class is None:
+            junk_classes.setdefault(tag_class, set()).add(tag_name)
+        else:
+            junk_tag_names.add(tag_name)
+    return (junk_ids, junk_classes, junk_tag_names, other_junk_selectors)
 
-    try:
-        wait(browser, WAIT_TIME).until(located((By.CSS_SELECTOR, "#navFooter")))
-    except TimeoutException as an_error:
-        foiled_agains = browser.find_elements(
-            By.CSS_SELECTOR, "form[action='/errors/validateCaptcha']"
-        )
-        if len(foiled_agains) > 0:
-            only(foiled_agains)
-            raise FoiledAgainError()
 
-        gones = browser.find_elements(
-            By.CSS_SELECTOR,
-            "img[alt=\"Sorry! We couldn't find that page. Try searching or go to Amazon's home page.\"]",
-        )
-        if len(gones) > 0:
-            # sanity check
-            only(gones)
-            # throw a custom error
-            raise GoneError()
-
-        went_wrongs = browser.find_elements(
-            By.CSS_SELECTOR,
-            'img[alt="Sorry! Something went wrong on our end. Please go back and try again or go to Amazon\'s home page."]',
-        )
-        if len(went_wrongs) > 0:
-            only(went_wrongs)
-            raise WentWrongError()
+COMPILED_JUNK_SELECTORS = compile_junk_selectors(JUNK_SELECTORS)
+
+
+def is_junk(tag, compiled_junk_selectors):
+    (junk_ids, junk_classes, junk_tag_names, other_junk_selectors) = (
+        compiled_junk_selectors
+    )
+    if tag.name in junk_tag_names:
+        return True
+    # an empty string means any tag name
+    tag_names = junk_ids.get(tag.get("id"))
+    if not tag_names is None and ("" in tag_names or tag.name in tag_names):
+        return True
+    for tag_class in tag.get("class", ()):
+        tag_names = junk_classes.get(tag_class)
+        if not tag_names is None and ("" in tag_names or tag.name in tag_names):
+            return True
+    return any(selector.match(tag) for selector in other_junk_selectors)
+
+
+# does everything clean_soup_in_passes does, in one walk through the page
+# junk, comments, and whitespace are removed on the way down
+# empty divs are found on the way back up, so each tag is only checked once
+def clean_soup(soup, compiled_junk_selectors=COMPILED_JUNK_SELECTORS):
+    # the ids of divs that only contain empty divs
+    empty_div_ids = set()
+    # a tag, and whether we've already cleaned its children
+    stack = [(soup, False)]
+    while stack:
+        (tag, children_cleaned) = stack.pop()
+        if children_cleaned:
+            if tag.name == "div" and all(
+                id(child) in empty_div_ids for child in tag.contents
+            ):
+                # let the parent decide whether to remove it
+                empty_div_ids.add(id(tag))
+            else:
+                # only remove the top-level empty divs
+                for child in list(tag.contents):
+                    if id(child) in empty_div_ids:
+                        child.extract()
+            continue
+
+        stack.append((tag, True))
+        for child in list(tag.contents):
+            if isinstance(child, Comment):
+                child.extract()
+            elif isinstance(child, NavigableString):
+                stripped = child.strip()
+                if stripped == "":
+                    child.extract()
+                elif child != stripped:
+                    child.replace_with(stripped)
+            elif is_junk(child, compiled_junk_selectors):
+                child.extract()
+            else:
+                stack.append((child, False))
+
+
+# add the time since start_time to a stage in timings, if we're timing
+def add_time(timings, stage, start_time):
+    end_time = perf_counter()
+    if not timings is None:
+        timings[stage] = timings.get(stage, 0.0) + end_time - start_time
+    return end_time
+
+
+def clean_html(page_source, timings=None):
+    start_time = perf_counter()
+    soup = BeautifulSoup(
+        page_source.encode("utf-8"), "lxml", from_encoding="UTF-8"
+    )
+    start_time = add_time(timings, "parse", start_time)
+    clean_soup(soup)
+    add_time(timings, "clean", start_time)
+    return soup
+
 
-        raise an_error
+# every amazon page has a footer, once it's loaded
+NAV_FOOTER_SELECTOR = "#navFooter"
+# if amazon stops us with a captcha
+FOILED_AGAIN_SELECTOR = "form[action='/errors/validateCaptcha']"
+# if the page no longer exists
+GONE_SELECTOR = "img[alt=\"Sorry! We couldn't find that page. Try searching or go to Amazon's home page.\"]"
+# if amazon tells us something "went wrong"
+WENT_WRONG_SELECTOR = 'img[alt="Sorry! Something went wrong on our end. Please go back and try again or go to Amazon\'s home page."]'
 
 
-def read_html(file):
-    with open(file, "r", encoding="UTF-8") as io:
-        soup = BeautifulSoup(io, "lxml", from_encoding="UTF-8")
-        remove_whitespace(soup)
-        return soup
+# parse a page, without the whitespace
+def parse_html(page_source):
+    soup = BeautifulSoup(page_source, "lxml")
+    remove_whitespace(soup)
+    return soup
 
 
 # stole from https://github.com/django/django/blob/main/django/utils/text.py